@@ -0,0 +1,66 @@
+import threading
+from collections import OrderedDict
+
+
+class LRUCache(object):
+# in-process cache, evicting the least recently used entries when it grows over a 
+# number of entries, or over a total size (as declared by the caller, e.g. in bytes)
+
+    max_items = 0
+    max_size = 0
+    size = 0
+    hits = 0
+    misses = 0
+
+    def __init__(self, max_items=0, max_size=0):
+        self.max_items = max_items
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            e = self.entries.get(key)
+            if e is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return e[0]
+
+    def put(self, key, value, size=0):
+        if self.max_size and size > self.max_size:
+            # would evict everything else, and still not fit
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            self.entries[key] = ( value, size )
+            self.size += size
+            while self.entries and (
+                (self.max_items and len(self.entries) > self.max_items) or
+                (self.max_size and self.size > self.max_size)
+            ):
+                _, ( _, sz ) = self.entries.popitem(last=False)
+                self.size -= sz
+
+    def delete(self, key):
+        with self.lock:
+            e = self.entries.pop(key, None)
+            if e is not None:
+                self.size -= e[1]
+
+    def invalidate(self, match=None):
+        # drop all entries, or only the ones with keys the match function returns true for
+        with self.lock:
+            for k in [ k for k in self.entries if match is None or match(k) ]:
+                self.size -= self.entries.pop(k)[1]
+
+    def stats(self):
+        return {
+            'items': len(self.entries),
+            'size': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
@@ -0,0 +1,290 @@
+import time
+import json
+import random
+import asyncio
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+import rq
+from rq.job import Job, JobStatus
+from rq.exceptions import DequeueTimeout
+
+from constants import *
+from backend.logger import log
+from backend.storage import rdbq
+
+
+class JobEngine(object):
+# runs the jobs from a set of rq queues, keeping up to a number of them in flight at the 
+# same time; the asyncio loop picks the jobs from the queues as long as there is room for
+# them, and hands them to a thread pool, since the job functions (rendering, redis and 
+# http requests) are blocking code. this replaces an rq worker, that only runs one job 
+# at a time
+
+    name = ""
+    queues = []
+    concurrency = 1
+    dequeue_timeout = 5
+    result_ttl = 500
+    stats_interval = 60
+
+    def __init__(self, name, queues, concurrency=1, weights=None):
+        self.name = name
+        self.queues = queues
+        # queue name -> weight; queues with a weight are checked in a weighted round robin,
+        # ahead of the others: a queue with a higher weight goes first more often, but the
+        # lower weight ones still get their share of the executors, as long as they have jobs
+        self.weights = weights or {}
+        self.credits = { q: 0 for q in self.weights }
+        self.concurrency = concurrency
+        self.executor = ThreadPoolExecutor(concurrency + 1, thread_name_prefix="executor")
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.usage = {}      # thread name -> [ jobs, busy seconds ]
+        self.timed_out = set()
+
+    def run(self):
+        asyncio.run(self._loop())
+
+    async def _loop(self):
+        loop = asyncio.get_running_loop()
+        slots = asyncio.Semaphore(self.concurrency)
+        log.info("[{}] job engine started on {}, {} jobs in flight"
+            .format(self.name, [ q.name for q in self.queues ], self.concurrency)
+        )
+        loop.create_task(self._report())
+        while True:
+            await slots.acquire()
+            try:
+                job = await loop.run_in_executor(self.executor, self._dequeue)
+            except Exception as e:
+                log.warning("[{}] failed picking up a job: {}".format(self.name, e))
+                job = None
+                await asyncio.sleep(1)
+            if job is None:
+                slots.release()
+                continue
+            loop.create_task(self._execute(job, slots))
+
+    async def _execute(self, job, slots):
+        # the job is failed when it runs longer than its timeout, like rq does; its thread
+        # can't be stopped though, so the slot is only released when the thread is done
+        loop = asyncio.get_running_loop()
+        f = loop.run_in_executor(self.executor, self._perform, job)
+        timeout = job.timeout if job.timeout and job.timeout > 0 else None
+        try:
+            await asyncio.wait_for(asyncio.shield(f), timeout)
+        except asyncio.TimeoutError:
+            with self.lock:
+                self.timed_out.add(job.id)
+            log.warning("[{}] job {} exceeded its timeout of {}s".format(self.name, job.id, timeout))
+            try:
+                await loop.run_in_executor(None, self._fail, job, 
+                    "JobTimeoutException: job exceeded maximum timeout value ({} seconds)".format(timeout)
+                )
+            except Exception as e:
+                log.warning("[{}] failed marking job {} as failed: {}".format(self.name, job.id, e))
+            await asyncio.wait([ f ])
+        finally:
+            slots.release()
+
+    def _queue_order(self):
+        # smooth weighted round robin on which weighted queue is checked first; the others
+        # follow in the order of their weights, then the queues without a weight
+        if not self.weights:
+            return self.queues
+        with self.lock:
+            for n, w in self.weights.items():
+                self.credits[n] += w
+            first = max(self.credits, key=self.credits.get)
+            self.credits[first] -= sum(self.weights.values())
+        rank = lambda q: ( q.name not in self.weights, q.name != first, -self.weights.get(q.name, 0) )
+        return sorted(self.queues, key=rank)
+
+    def _dequeue(self):
+        try:
+            r = rq.Queue.dequeue_any(self._queue_order(), self.dequeue_timeout, connection=rdbq)
+        except DequeueTimeout:
+            return None
+        return r[0] if r else None
+
+    def _perform(self, job):
+        # execute the job like an rq worker would; a job function that puts its job back 
+        # in a queue (see models.gateway.reschedule) changes the job status, so the job is 
+        # only marked as finished if the status didn't change
+        started = time.time()
+        try:
+            job.set_status(JobStatus.STARTED)
+            job.perform()
+            if not self._expired(job) and job.get_status() == JobStatus.STARTED:
+                job.set_status(JobStatus.FINISHED)
+                job.cleanup(self.result_ttl)
+        except Exception as e:
+            log.warning("[{}] job {} failed: {}".format(self.name, job.id, e))
+            log.debug(traceback.format_exc())
+            if not self._expired(job):
+                self._fail(job, traceback.format_exc())
+        duration = time.time() - started
+        with self.lock:
+            u = self.usage.setdefault(threading.current_thread().name, [ 0, 0. ])
+            u[0] += 1
+            u[1] += duration
+        log.debug("[{}] job {} done in {:.3f}s".format(self.name, job.id, duration))
+
+    def _expired(self, job):
+        # the job was failed already, for running longer than its timeout
+        with self.lock:
+            if job.id in self.timed_out:
+                self.timed_out.discard(job.id)
+                return True
+        return False
+
+    def _fail(self, job, exc_string):
+        # failed jobs go in the failed jobs registry of their queue, like with an rq 
+        # worker, where they can be inspected and requeued
+        p = rdbq.pipeline()
+        job.set_status(JobStatus.FAILED, pipeline=p)
+        rq.Queue(job.origin, connection=rdbq).failed_job_registry.add(job, 
+            ttl=job.failure_ttl, exc_string=exc_string, pipeline=p
+        )
+        p.execute()
+
+    def stats(self):
+        # jobs executed and utilization (busy time over total time) of each executor thread,
+        # since the last call
+        now = time.time()
+        with self.lock:
+            usage, self.usage = self.usage, {}
+            elapsed, self.started = max(0.001, now - self.started), now
+        return {
+            name: { 'jobs': u[0], 'utilization': round(u[1] / elapsed, 3) }
+            for name, u in usage.items()
+        }
+
+    async def _report(self):
+        while True:
+            await asyncio.sleep(self.stats_interval)
+            st = self.stats()
+            log.info("[{}] executors: {}".format(self.name, st))
+            try:
+                p = rdbq.pipeline()
+                p.delete('gwexec-' + self.name)
+                if st:
+                    p.hmset('gwexec-' + self.name, { k: json.dumps(v) for k, v in st.items() })
+                p.expire('gwexec-' + self.name, 3 * self.stats_interval)
+                p.execute()
+            except Exception as e:
+                log.warning("[{}] failed storing executors stats: {}".format(self.name, e))
+
+
+# moves the jobs that are due from a delayed jobs sorted set to the end of their queue, 
+# like rq.Queue.enqueue_job would; there is a set for each queue (KEYS[2]), its members 
+# are the job ids, scored with the time they are due at. the job status and expiry are 
+# set again, in case something (e.g. an rq worker handling the job as successful) 
+# changed them while the job was waiting. the script runs on the redis server, so many
+# gateway instances can run it on the same set without moving a job twice
+PROMOTE_DUE_SCRIPT = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[2]))
+for _, id in ipairs(due) do
+    local key = ARGV[3] .. id
+    redis.call('ZREM', KEYS[1], id)
+    if redis.call('EXISTS', key) == 1 then
+        redis.call('HSET', key, 'status', 'queued')
+        local ttl = tonumber(redis.call('HGET', key, 'ttl'))
+        if ttl and ttl > 0 then
+            redis.call('EXPIRE', key, ttl)
+        else
+            redis.call('PERSIST', key)
+        end
+        redis.call('RPUSH', KEYS[2], id)
+    end
+end
+return #due
+"""
+
+
+# takes a job out of its queue (KEYS[1]) and puts it in the delayed set of the queue
+# (KEYS[2]), due at ARGV[2]; only if the job was still in the queue, and its key (KEYS[3])
+# still there. the key is kept for the lease (ARGV[3] seconds) at least: a job key that
+# expired meanwhile would be recreated partially by the next change to the job
+TAKE_SCRIPT = """
+if redis.call('EXISTS', KEYS[3]) == 0 or redis.call('LREM', KEYS[1], 1, ARGV[1]) == 0 then
+    return 0
+end
+redis.call('ZADD', KEYS[2], ARGV[2], ARGV[1])
+local ttl = redis.call('TTL', KEYS[3])
+if ttl >= 0 and ttl < tonumber(ARGV[3]) then
+    redis.call('EXPIRE', KEYS[3], ARGV[3])
+end
+return 1
+"""
+
+
+class DelayedJobs(object):
+# jobs put aside until a moment in time, without any worker having to hold them: a 
+# sorted set for each queue, scored with the time the jobs are due at, and a thread 
+# promoting the due ones back into their queue once in a while
+
+    queues = []
+    interval = 1
+    batch = 100
+    script = None
+    take_script = None
+
+    def __init__(self, queues):
+        # the names of the queues the jobs are put back in
+        self.queues = queues
+        self.script = rdbq.register_script(PROMOTE_DUE_SCRIPT) if rdbq else None
+        self.take_script = rdbq.register_script(TAKE_SCRIPT) if rdbq else None
+
+    @staticmethod
+    def key(queue_name):
+        return "rq:delayed:" + queue_name
+
+    @staticmethod
+    def backoff(attempt, base, ceiling):
+        # exponential delay, with a random half of it, so that the jobs failed at the same
+        # time (e.g. during an outage of the peer) don't all come back at the same time
+        d = min(ceiling, base * (2 ** attempt))
+        return d / 2 + random.uniform(0, d / 2)
+
+    def schedule(self, job, queue, delay, ttl=None, pipeline=None):
+        # the job key must outlive the delay, whatever its queue ttl was
+        p = pipeline or rdbq.pipeline()
+        job.set_status(JobStatus.DEFERRED, pipeline=p)
+        p.expire(job.key, int(delay + (ttl or 0)) + 60)
+        p.zadd(self.key(queue.name), { job.id: time.time() + delay })
+        if pipeline is None:
+            p.execute()
+
+    def take(self, queue_name, job_id, lease):
+        # take a job waiting in a queue, to run it along with another one: the job comes 
+        # back in the queue after lease seconds, unless released or scheduled meanwhile
+        return self.take_script(keys=[ 
+                rq.Queue.redis_queue_namespace_prefix + queue_name, self.key(queue_name), 
+                Job.redis_job_namespace_prefix + job_id 
+            ], 
+            args=[ job_id, time.time() + lease, int(lease) + 60 ]
+        ) == 1
+
+    def release(self, queue_name, job_id):
+        rdbq.zrem(self.key(queue_name), job_id)
+
+    def promote(self, queue_name):
+        return self.script(keys=[ self.key(queue_name), rq.Queue.redis_queue_namespace_prefix + queue_name ], 
+            args=[ time.time(), self.batch, Job.redis_job_namespace_prefix ]
+        )
+
+    @classmethod
+    def count(cls, queue_name):
+        return rdbq.zcard(cls.key(queue_name))
+
+    def run(self):
+        while True:
+            for q in self.queues:
+                try:
+                    while self.promote(q) >= self.batch:
+                        pass
+                except Exception as e:
+                    log.warning("[{}] failed promoting delayed jobs: {}".format(self.key(q), e))
+            time.sleep(self.interval)
@@ -0,0 +1,501 @@
+import os
+import base64
+import quopri
+import json
+import uuid
+import mmap
+import binascii
+import smtplib
+import email.parser
+
+CRLF = b"\r\n"
+
+
+class WireBody(object):
+# a MIME body in its wire form (CRLF line endings), made of the pieces it was written
+# with, that are never joined together: the pieces are sent one after the other, so
+# the memory needed is that of the pieces, not of a full copy of the message. it has a
+# length, so requests sends it with a Content-Length, and not chunked
+
+    block_size = 64 * 1024
+
+    def __init__(self):
+        self.chunks = []
+        self.length = 0
+
+    def write(self, data):
+        # bytes (or str) to be sent as they are, or an object producing them, like
+        # Base64File; an object needs a length, and to produce the bytes when iterated
+        if isinstance(data, str):
+            data = data.encode()
+        if len(data):
+            self.chunks.append(data)
+            self.length += len(data)
+
+    def extend(self, body):
+        # the pieces of another body, not copied
+        self.chunks.extend(body.chunks)
+        self.length += body.length
+
+    def resident(self):
+        # bytes held in memory, without those produced on the fly
+        return sum(len(c) for c in self.chunks if isinstance(c, ( bytes, bytearray )))
+
+    def valid(self):
+        # the files the body refers to are still the same
+        return all(c.valid() for c in self.chunks if hasattr(c, "valid"))
+
+    def headers(self, headers):
+        # a header block, as a list of ( name, value ) tuples, and the empty line after it
+        for name, value in headers:
+            self.write(name + ": " + value + "\r\n")
+        self.write(CRLF)
+
+    def part(self, boundary, headers, body):
+        self.write("--" + boundary + "\r\n")
+        self.headers(headers)
+        if isinstance(body, WireBody):
+            self.extend(body)
+        else:
+            self.write(body)
+        self.write(CRLF)
+
+    def close(self, boundary):
+        self.write("--" + boundary + "--\r\n")
+
+    def head(self, size):
+        # the first bytes of the body, for logging
+        h = b""
+        for c in self.chunks:
+            if not isinstance(c, ( bytes, bytearray )):
+                break
+            h += bytes(c[:size - len(h)])
+            if len(h) >= size:
+                break
+        return h.decode(errors="replace")
+
+    def tail(self, size):
+        t = b""
+        for c in reversed(self.chunks):
+            if not isinstance(c, ( bytes, bytearray )):
+                break
+            t = bytes(c[-(size - len(t)):]) + t
+            if len(t) >= size:
+                break
+        return t.decode(errors="replace")
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        for c in self.chunks:
+            if not isinstance(c, ( bytes, bytearray )):
+                yield from c
+                continue
+            m = memoryview(c)
+            for i in range(0, len(m), self.block_size):
+                yield m[i:i + self.block_size]
+
+
+class Base64File(object):
+# the base64 transfer encoding of a file, in lines of 76 characters (57 bytes of the 
+# file) with CRLF endings; the file is memory mapped, and encoded in blocks while being
+# sent, so it is never loaded or encoded in memory as a whole
+
+    line_size = 57
+    block_lines = 1024
+
+    def __init__(self, fn):
+        self.fn = fn
+        st = os.stat(fn)
+        self.stamp = ( st.st_mtime, st.st_size )
+        self.size = st.st_size
+        full, rest = divmod(self.size, self.line_size)
+        self.length = full * 78 + ((4 * ((rest + 2) // 3) + 2) if rest else 0)
+
+    def valid(self):
+        try:
+            st = os.stat(self.fn)
+        except OSError:
+            return False
+        return ( st.st_mtime, st.st_size ) == self.stamp
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        if self.size == 0:
+            return
+        block = self.line_size * self.block_lines
+        with open(self.fn, "rb") as fh, mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            m = memoryview(mm)
+            try:
+                for offset in range(0, self.size, block):
+                    yield b"".join(
+                        binascii.b2a_base64(m[i:min(i + self.line_size, self.size)], newline=False) + CRLF
+                        for i in range(offset, min(offset + block, self.size), self.line_size)
+                    )
+            finally:
+                m.release()
+
+
+class SplicedFile(object):
+# the content of a file, sent as it is, from a memory map of the file; when the file 
+# was made from another one (source), it is only valid as long as the source is
+
+    block_size = 64 * 1024
+
+    def __init__(self, fn, source=None):
+        self.fn = fn
+        self.source = source
+        st = os.stat(fn)
+        self.stamp = ( st.st_mtime, st.st_size )
+        self.length = st.st_size
+
+    def valid(self):
+        try:
+            st = os.stat(self.fn)
+        except OSError:
+            return False
+        return ( st.st_mtime, st.st_size ) == self.stamp and (self.source is None or self.source.valid())
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        if self.length == 0:
+            return
+        # the blocks are copied out of the map, since the receiver may still hold them when
+        # the map is closed
+        with open(self.fn, "rb") as fh, mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for i in range(0, self.length, self.block_size):
+                yield mm[i:i + self.block_size]
+
+
+def pre_encoded(fn):
+    # the transfer encoded content of a file, and its Content-Transfer-Encoding; the 
+    # content is spliced from an encoded copy of the file (fn + ".b64"), written next to 
+    # it the first time it is needed, and described by fn + ".b64.json". the copy and its
+    # description are written to temporary files and renamed, so that all the processes 
+    # sharing the directory, on any host, only see complete copies
+    src = Base64File(fn)
+    art = fn + ".b64"
+    try:
+        with open(art + ".json", "r") as fh:
+            meta = json.load(fh)
+        if [ meta['size'], meta['mtime'], meta['length'] ] == [ src.size, src.stamp[0], src.length ]:
+            spliced = SplicedFile(art, src)
+            if spliced.length == src.length:
+                return spliced, meta['encoding']
+    except (OSError, ValueError, KeyError):
+        pass
+    tmp = art + ".tmp-" + uuid.uuid4().hex
+    try:
+        with open(tmp, "wb") as fh:
+            for b in src:
+                fh.write(b)
+        os.rename(tmp, art)
+        with open(tmp, "w") as fh:
+            json.dump({ 
+                'encoding': "base64", 
+                'size': src.size, 
+                'mtime': src.stamp[0], 
+                'length': src.length 
+            }, fh)
+        os.rename(tmp, art + ".json")
+        return SplicedFile(art, src), "base64"
+    except OSError:
+        # encode on the fly then
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        return src, "base64"
+
+
+def dot_stuffed(chunks):
+    # SMTP DATA transparency: a line starting with a dot gets another dot in front
+    bol = True
+    for c in chunks:
+        b = bytes(c)
+        if not b:
+            continue
+        if b"\n." in b:
+            b = b.replace(b"\n.", b"\n..")
+        if bol and b[:1] == b".":
+            b = b"." + b
+        bol = b.endswith(b"\n")
+        yield b
+
+
+class DataInterrupted(smtplib.SMTPServerDisconnected):
+# the session was lost once the DATA command was sent: the message may have been 
+# accepted by the server anyway, so it is not to be sent again on another session
+    pass
+
+
+def smtp_send(conn, from_addr, to_addrs, body):
+    # like smtplib.SMTP.sendmail(), but the message is a WireBody, sent in blocks as it 
+    # is produced, instead of being built as a single string first
+    conn.ehlo_or_helo_if_needed()
+    options = [ "size={}".format(len(body)) ] if conn.does_esmtp and conn.has_extn("size") else []
+    code, resp = conn.mail(from_addr, options)
+    if code != 250:
+        conn._rset()
+        raise smtplib.SMTPSenderRefused(code, resp, from_addr)
+    if isinstance(to_addrs, str):
+        to_addrs = [ to_addrs ]
+    refused = {}
+    for a in to_addrs:
+        code, resp = conn.rcpt(a)
+        if code not in ( 250, 251 ):
+            refused[a] = ( code, resp )
+    if len(refused) == len(to_addrs):
+        conn._rset()
+        raise smtplib.SMTPRecipientsRefused(refused)
+    try:
+        conn.putcmd("data")
+        code, resp = conn.getreply()
+        if code != 354:
+            conn._rset()
+            raise smtplib.SMTPDataError(code, resp)
+        # the terminating dot is a line by itself: like smtplib.SMTP.data(), a line
+        # break is added when the body does not end with one
+        tail = b""
+        for b in dot_stuffed(body):
+            conn.send(b)
+            tail = (tail + b[-2:])[-2:]
+        if tail != CRLF:
+            conn.send(CRLF)
+        conn.send(b".\r\n")
+        code, resp = conn.getreply()
+    except (smtplib.SMTPServerDisconnected, OSError) as e:
+        raise DataInterrupted(str(e))
+    if code != 250:
+        conn._rset()
+        raise smtplib.SMTPDataError(code, resp)
+    return refused
+
+
+class BodyTooLarge(ValueError):
+    pass
+
+
+class MultipartReader(object):
+# reads a multipart body from a stream, one part at a time, in blocks: the headers of a
+# part are parsed, and its body is handed over to a writer function as it arrives, so 
+# the body is never held in memory as a whole. the reader stops with BodyTooLarge when 
+# more than max_size bytes are read, or with a ValueError when the body ends before the 
+# closing delimiter
+
+    block_size = 64 * 1024
+    max_headers = 64 * 1024
+
+    def __init__(self, fh, boundary, length=None, max_size=0):
+        self.fh = fh
+        self.left = length
+        self.max_size = max_size
+        self.read = 0
+        self.delim = b"\n--" + boundary.encode()
+        # a delimiter is a line by itself, so the first one needs a line break in front
+        self.buf = b"\r\n"
+        self.started = False
+        self.ended = False
+
+    def _fill(self):
+        n = self.block_size if self.left is None else min(self.block_size, self.left)
+        b = self.fh.read(n) if n > 0 else b""
+        if not b:
+            return False
+        if self.left is not None:
+            self.left -= len(b)
+        self.read += len(b)
+        if self.max_size and self.read > self.max_size:
+            raise BodyTooLarge("body larger than {} bytes".format(self.max_size))
+        self.buf += b
+        return True
+
+    def _body(self, write):
+        # hand over the data up to the next delimiter, and stop at the delimiter
+        while True:
+            i = self.buf.find(self.delim)
+            if i >= 0:
+                data = self.buf[:i]
+                write(data[:-1] if data.endswith(b"\r") else data)
+                self.buf = self.buf[i + 1:]
+                return
+            # the end of the buffer may be the beginning of a delimiter
+            keep = len(self.delim) + 1
+            if len(self.buf) > keep:
+                write(self.buf[:-keep])
+                self.buf = self.buf[-keep:]
+            if not self._fill():
+                raise ValueError("body ended before the closing delimiter")
+
+    def next_part(self):
+        # the headers of the next part, as an email.message.Message, or None after the last
+        # part; the body of the part is to be read with read_body()
+        if self.ended:
+            return None
+        if not self.started:
+            # discard the preamble
+            self._body(lambda data: None)
+            self.started = True
+        while len(self.buf) < len(self.delim) + 1 and self._fill():
+            pass
+        if self.buf[len(self.delim) - 1:].startswith(b"--"):
+            self.ended = True
+            return None
+        while True:
+            # the rest of the delimiter line, then the headers up to an empty line
+            eol = self.buf.find(b"\n")
+            if eol >= 0 and len(self.buf) >= eol + 3:
+                start = eol + 1
+                if self.buf[start:start + 1] == b"\n":
+                    end, body = start, start + 1
+                elif self.buf[start:start + 2] == b"\r\n":
+                    end, body = start, start + 2
+                else:
+                    # the line break ending the last header, followed by an empty line
+                    ends = [ ( i + 1, i + n ) for i, n in ( 
+                        ( self.buf.find(b"\n\r\n", start), 3 ), 
+                        ( self.buf.find(b"\n\n", start), 2 ) 
+                    ) if i >= 0 ]
+                    end, body = min(ends) if ends else ( None, None )
+                if end is not None:
+                    headers = self.buf[start:end]
+                    self.buf = self.buf[body:]
+                    return email.parser.BytesHeaderParser().parsebytes(headers)
+            if len(self.buf) > self.max_headers:
+                raise ValueError("part headers larger than {} bytes".format(self.max_headers))
+            if not self._fill():
+                raise ValueError("body ended in the part headers")
+
+    def read_body(self, write):
+        self._body(write)
+
+    def read_all(self):
+        data = []
+        self._body(data.append)
+        return b"".join(data)
+
+
+class BodyDecoder(object):
+# undoes the Content-Transfer-Encoding of a body handed over in blocks, and hands the 
+# content over in blocks too: base64 is decoded in groups of 4 characters, and 
+# quoted-printable in whole lines, the rest is kept for the next block
+
+    def __init__(self, encoding, write):
+        self.encoding = (encoding or "").strip().lower()
+        self.out = write
+        self.rest = b""
+
+    def write(self, data):
+        data = bytes(data)
+        if self.encoding == "base64":
+            data = self.rest + data.translate(None, b" \t\r\n")
+            n = len(data) - len(data) % 4
+            self.rest = data[n:]
+            if n:
+                self.out(binascii.a2b_base64(data[:n]))
+        elif self.encoding == "quoted-printable":
+            data = self.rest + data
+            n = data.rfind(b"\n") + 1
+            self.rest = data[n:]
+            if n:
+                self.out(binascii.a2b_qp(data[:n]))
+        elif data:
+            self.out(data)
+
+    def close(self):
+        rest, self.rest = self.rest, b""
+        if not rest:
+            return
+        if self.encoding == "base64":
+            # missing padding is tolerated, like the email package does
+            try:
+                self.out(binascii.a2b_base64(rest + b"=" * (-len(rest) % 4)))
+            except binascii.Error:
+                pass
+        else:
+            self.out(binascii.a2b_qp(rest))
+
+
+def read_headers(fh, max_size=64 * 1024):
+    # the header block at the current position of a binary stream, up to the empty line
+    # after it, as an email.message.Message; the stream is left at the start of the body
+    block = []
+    size = 0
+    while True:
+        line = fh.readline(max_size + 1)
+        if line in ( b"", b"\r\n", b"\n" ):
+            break
+        size += len(line)
+        if size > max_size:
+            raise ValueError("headers larger than {} bytes".format(max_size))
+        block.append(line)
+    return email.parser.BytesHeaderParser().parsebytes(b"".join(block))
+
+
+class MIMEFile(object):
+# a MIME message stored in a file: only its headers are parsed when opened, and its 
+# parts are read from the file one at a time, when iterated, with their content 
+# decoded in blocks, so that a part is never held in memory as a whole
+
+    block_size = 64 * 1024
+
+    def __init__(self, fn):
+        self.fn = fn
+        with open(fn, "rb") as fh:
+            self.headers = read_headers(fh)
+            self.offset = fh.tell()
+
+    def multipart(self):
+        return self.headers.get_content_maintype() == "multipart"
+
+    def parts(self):
+        # ( headers, read ) for each part; read(write) hands the decoded content of the 
+        # part over to the write function. a part not read is skipped
+        with open(self.fn, "rb") as fh:
+            fh.seek(self.offset)
+            if not self.multipart():
+                yield self.headers, self._content(self.headers, lambda write: self._copy(fh, write))[0]
+                return
+            reader = MultipartReader(fh, self.headers.get_param("boundary", ""))
+            while True:
+                headers = reader.next_part()
+                if headers is None:
+                    return
+                read, state = self._content(headers, reader.read_body)
+                yield headers, read
+                if not state['read']:
+                    reader.read_body(lambda data: None)
+
+    def _content(self, headers, read_body):
+        state = { 'read': False }
+        def read(write):
+            state['read'] = True
+            decoder = BodyDecoder(headers.get('Content-Transfer-Encoding'), write)
+            read_body(decoder.write)
+            decoder.close()
+        return read, state
+
+    def _copy(self, fh, write):
+        while True:
+            b = fh.read(self.block_size)
+            if not b:
+                return
+            write(b)
+
+
+def wire(text):
+    # text with LF line endings, as the email package generates it, in wire form
+    return text.replace("\r\n", "\n").replace("\n", "\r\n").encode()
+
+
+def decoded(data, encoding=None):
+    # the content of a part, with its Content-Transfer-Encoding undone
+    encoding = (encoding or "").strip().lower()
+    if encoding == "base64":
+        return base64.b64decode(data)
+    if encoding == "quoted-printable":
+        return quopri.decodestring(data)
+    return data
@@ -0,0 +1,160 @@
+import time
+import queue
+import threading
+import contextlib
+import smtplib
+import requests
+import urllib3
+
+from constants import *
+from backend.logger import log
+
+
+class SMTPPool(object):
+# pool of persistent SMTP sessions to the same server; sessions are created on demand 
+# with the factory function, up to the pool size, and reused afterwards. a session that
+# stayed idle for a while gets checked with a NOOP before being reused, and a session 
+# that failed is dropped, so that a new one gets created in its place
+
+    name = ""
+    size = 1
+    max_idle = 30
+    created = 0
+    reused = 0
+
+    def __init__(self, name, factory, size=1, max_idle=30):
+        self.name = name
+        self.factory = factory
+        self.size = size
+        self.max_idle = max_idle
+        self.idle = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(size)
+
+    @contextlib.contextmanager
+    def session(self, timeout=None):
+        if not self.slots.acquire(timeout=timeout):
+            raise smtplib.SMTPException("no SMTP session available in pool {}".format(self.name))
+        conn = None
+        try:
+            conn = self._get()
+            yield conn
+        except (smtplib.SMTPServerDisconnected, OSError):
+            self._close(conn)
+            conn = None
+            raise
+        finally:
+            if conn is not None:
+                self.idle.put(( time.time(), conn ))
+            self.slots.release()
+
+    def _get(self):
+        while True:
+            try:
+                ts, conn = self.idle.get_nowait()
+            except queue.Empty:
+                conn = self.factory()
+                if conn is None:
+                    raise smtplib.SMTPServerDisconnected("cannot connect")
+                self.created += 1
+                return conn
+            if time.time() - ts < self.max_idle:
+                self.reused += 1
+                return conn
+            try:
+                if conn.noop()[0] == 250:
+                    self.reused += 1
+                    return conn
+            except (smtplib.SMTPException, OSError) as e:
+                log.debug("[{}] dropping idle SMTP session: {}".format(self.name, e))
+            self._close(conn)
+
+    def _close(self, conn):
+        if conn is None:
+            return
+        try:
+            conn.quit()
+        except (smtplib.SMTPException, OSError):
+            conn.close()
+
+    def close(self):
+        while True:
+            try:
+                _, conn = self.idle.get_nowait()
+            except queue.Empty:
+                return
+            self._close(conn)
+
+    def stats(self):
+        return {
+            'size': self.size,
+            'idle': self.idle.qsize(),
+            'created': self.created,
+            'reused': self.reused,
+        }
+
+
+class HTTPPool(object):
+# keep-alive http(s) connections, shared by all the requests to the same hosts; keeps 
+# track of how many connections were made, how long it took to connect (including the 
+# TLS handshake), and how many requests reused an already open connection
+
+    name = ""
+    requests = 0
+    connects = 0
+    connect_time = 0.
+    max_connect_time = 0.
+
+    def __init__(self, name, per_host=10, hosts=4):
+        self.name = name
+        self.lock = threading.Lock()
+        self.session = requests.Session()
+        adapter = _TimedAdapter(self, pool_connections=hosts, pool_maxsize=per_host, pool_block=True)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def request(self, method, url, **kwargs):
+        with self.lock:
+            self.requests += 1
+        return self.session.request(method, url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def connected(self, duration):
+        with self.lock:
+            self.connects += 1
+            self.connect_time += duration
+            self.max_connect_time = max(self.max_connect_time, duration)
+
+    def close(self):
+        self.session.close()
+
+    def stats(self):
+        return {
+            'requests': self.requests,
+            'connects': self.connects,
+            'reused': max(0, self.requests - self.connects),
+            'avg_connect_time': (self.connect_time / self.connects) if self.connects else 0,
+            'max_connect_time': self.max_connect_time,
+        }
+
+
+class _TimedAdapter(requests.adapters.HTTPAdapter):
+# transport adapter timing the connections made by its connection pools
+
+    def __init__(self, http_pool, **kwargs):
+        self.http_pool = http_pool
+        super(_TimedAdapter, self).__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super(_TimedAdapter, self).init_poolmanager(*args, **kwargs)
+        http_pool = self.http_pool
+        pool_classes = {}
+        for scheme, pool_cls in urllib3.poolmanager.pool_classes_by_scheme.items():
+            class TimedConnection(pool_cls.ConnectionCls):
+                def connect(self):
+                    t = time.time()
+                    super().connect()
+                    http_pool.connected(time.time() - t)
+            pool_classes[scheme] = type(pool_cls.__name__, ( pool_cls, ), { 'ConnectionCls': TimedConnection })
+        self.poolmanager.pool_classes_by_scheme = pool_classes
@@ -0,0 +1,71 @@
+import email.utils
+
+
+class RoutingTable(object):
+# the entries of a routing section, indexed for lookups that don't depend on the number
+# of entries: an address ("user@domain.com"), a domain ("domain.com", "@domain.com" or
+# "*@domain.com"), or a wildcard for all the subdomains of a domain ("*.domain.com");
+# names are matched on the address first, on the domain next, and on the longest 
+# wildcard suffix last. peer host names and IP addresses are entered as domains
+
+    def __init__(self, section=None):
+        self.addresses = {}
+        self.domains = {}
+        self.wildcards = {}
+        for key, gw in (section or {}).items():
+            self.add(key, gw)
+
+    def add(self, key, gw):
+        key = key.strip().lower()
+        if "@" in key:
+            local, _, domain = key.rpartition("@")
+            if local not in ( "", "*" ):
+                self.addresses[key] = gw
+                return
+            key = domain
+        if key.startswith("*."):
+            self.wildcards[key[2:]] = gw
+        else:
+            self.domains[key] = gw
+
+    def match(self, name):
+        if not name:
+            return None
+        name = name.strip().lower()
+        if "@" in name:
+            gw = self.addresses.get(name)
+            if gw is not None:
+                return gw
+            name = name.rpartition("@")[2]
+        gw = self.domains.get(name)
+        if gw is not None:
+            return gw
+        labels = name.split(".")
+        for i in range(1, len(labels)):
+            gw = self.wildcards.get(".".join(labels[i:]))
+            if gw is not None:
+                return gw
+        return None
+
+
+class RoutingIndex(object):
+# finds the gateway handling a message: by receiver address first, by sending host 
+# next, and by sender address last. the tables are built once, from the receivers, 
+# peers and senders sections of the configuration
+
+    def __init__(self, cfg):
+        self.receivers = RoutingTable(cfg['receivers'] if cfg.has_section('receivers') else None)
+        self.peers = RoutingTable(cfg['peers'] if cfg.has_section('peers') else None)
+        self.senders = RoutingTable(cfg['senders'] if cfg.has_section('senders') else None)
+
+    def lookup(self, sender, receiver, source=()):
+        # the source is a list of names of the sending host: its IP address, the name it
+        # presented itself with in HELO/EHLO
+        gw = self.receivers.match(email.utils.parseaddr(receiver)[1])
+        for name in source:
+            if gw is not None:
+                break
+            gw = self.peers.match(name)
+        if gw is None:
+            gw = self.senders.match(email.utils.parseaddr(sender)[1])
+        return gw
@@ -0,0 +1,81 @@
+import time
+
+from constants import *
+from backend.logger import log
+from backend.storage import rdbq
+
+
+# token bucket kept in a redis hash, shared by all the instances of a gateway group, on
+# all hosts; the clock is the redis server time, so instances don't depend on their own
+# clocks being in sync. a token is always taken: when the bucket is empty, the level goes
+# negative, and the caller gets back how long it has to wait for its turn; this spreads
+# the waiting instances evenly, instead of having them all retry at the same time
+TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local take = tonumber(ARGV[3])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local b = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(b[1]) or burst
+local ts = tonumber(b[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate) - take
+redis.call('HMSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now), 'rate', ARGV[1], 'burst', ARGV[2])
+redis.call('EXPIRE', KEYS[1], math.ceil((burst - tokens) / rate) + 60)
+local wait = 0
+if tokens < 0 then wait = -tokens / rate end
+return { tostring(tokens), tostring(wait) }
+"""
+
+
+class TokenBucket(object):
+
+    key = None
+    rate = 0
+    burst = 1
+    script = None
+
+    def __init__(self, name, rate, burst=None):
+        self.key = 'gwtps-' + name
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self.script = rdbq.register_script(TOKEN_BUCKET_SCRIPT) if rdbq else None
+
+    def acquire(self, tokens=1):
+        # take tokens from the bucket, and return the number of seconds to wait before
+        # the transmission is allowed to go
+        if self.script is None or self.rate <= 0:
+            return 0
+        try:
+            _, wait = self.script(keys=[ self.key ], args=[ self.rate, self.burst, tokens ])
+            return float(wait)
+        except Exception as e:
+            # rather go unthrottled than stop sending altogether
+            log.warning("[{}] token bucket unavailable: {}".format(self.key, e))
+            return 0
+
+    def wait(self, tokens=1):
+        w = self.acquire(tokens)
+        if w > 0:
+            time.sleep(w)
+        return w
+
+    def level(self):
+        # current token level, without taking any; negative values mean that many
+        # transmissions are already waiting for their turn. this only reads the bucket,
+        # so it can be used from outside the gateway instances (e.g. by the API), where
+        # rate and burst are not configured
+        if rdbq is None:
+            return None
+        try:
+            b = rdbq.hgetall(self.key)
+            if not b:
+                return None
+            rate = float(b.get(b'rate', self.rate))
+            burst = float(b.get(b'burst', self.burst))
+            secs, usecs = rdbq.time()
+            elapsed = max(0, secs + usecs / 1000000. - float(b[b'ts']))
+            return min(burst, float(b[b'tokens']) + elapsed * rate)
+        except Exception as e:
+            log.warning("[{}] token bucket unavailable: {}".format(self.key, e))
+            return None
@@ -15,7 +15,7 @@ from backend.logger import log
 
 def cb_post(url, jdata):
     log.info(">>>> [callback] POSTing to {}: {}".format(url, jdata))
-    rq = requests.post(url, headers={ 'User-Agent': USER_AGENT }, json=json.loads(jdata))
+    rq = requests.post(url, headers={ 'User-Agent': USER_AGENT }, json=json.loads(jdata), timeout=CB_TIMEOUT)
     if rq.status_code >= 400:
         log.warning(">>>> [callback] POSTing to {} failed with status {}: {}"
             .format(url, rq.status_code, rq.text)
@@ -66,20 +66,41 @@ class FileSchemeAdapter(requests.adapters.BaseAdapter):
         pass
 
 
-def download_to_file(url, save_as=None):
+def download_to_file(url, save_as=None, timeout=None, max_time=None):
+    # the content is downloaded into a temporary file, then renamed, so that readers 
+    # never see a partially written file; timeout is passed to requests, as a 
+    # ( connect, read ) tuple, and the download is abandoned after max_time seconds
     fn = save_as or "/tmp/" + random_string(12)
+    tmp_fn = fn + ".tmp-" + random_string(6)
     rq_session = requests.session()
     rq_session.mount('file://', FileSchemeAdapter())
-    rp = rq_session.get(url, headers={ 'User-Agent': USER_AGENT }, stream=True)
+    rp = rq_session.get(url, headers={ 'User-Agent': USER_AGENT }, stream=True, timeout=timeout)
     if rp.status_code == 200:
-        with open(fn, 'wb') as fh:
-            for chunk in rp.iter_content(4096):
-                fh.write(chunk)    
+        deadline = time.time() + max_time if max_time else None
+        try:
+            with open(tmp_fn, 'wb') as fh:
+                for chunk in rp.iter_content(65536):
+                    if deadline and time.time() > deadline:
+                        raise IOError("download of {} took longer than {} seconds".format(url, max_time))
+                    fh.write(chunk)
+            os.rename(tmp_fn, fn)
+        except Exception:
+            if os.path.exists(tmp_fn):
+                os.remove(tmp_fn)
+            raise
         return fn
     else:
         return None
 
 
+def tx_queue_name(gateway, priority=""):
+    # transmission queue of a gateway for a message priority; normal priority messages 
+    # go in the QTX-<gateway> queue, the others in their own lane
+    if priority in ( "", "normal" ) or priority not in ACCEPTED_MESSAGE_PRIORITIES:
+        return "QTX-" + gateway
+    return "QTX-" + gateway + "-" + priority
+
+
 def find_in_dict(d, k):
     if k in d: return d[k]
     for kk, v in list(d.items()):
@@ -0,0 +1,277 @@
+import os
+import time
+import json
+import socket
+import random
+import asyncio
+import threading
+import traceback
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+import rq
+from rq.job import JobStatus
+from rq.exceptions import DequeueTimeout
+
+from constants import *
+from backend.logger import log
+from backend.storage import rdbq
+from backend.pool import HTTPPool
+from backend.engine import DelayedJobs
+
+
+class WebhookEngine(object):
+# delivers the callback jobs (see backend.util.cb_post) to the app: up to a number of 
+# requests in flight, and fewer to the same host, so that a slow app endpoint doesn't 
+# hold up the others; connections to each host are kept alive. a failed request is not 
+# waited for: its jobs go in the delayed set of their queue, and come back after an 
+# exponential backoff. events for the urls configured for batching are sent in batches, 
+# and retried in place instead, see _batch_sender()
+
+    name = ""
+    queues = []
+    dequeue_timeout = 5
+    stats_interval = 60
+    result_ttl = 500
+    cb_func = "backend.util.cb_post"
+
+    def __init__(self, queues):
+        self.name = "callback:{}:{}".format(socket.gethostname(), os.getpid())
+        self.queues = queues
+        self.http = HTTPPool(self.name, CB_PER_HOST, CB_CONCURRENCY)
+        self.executor = ThreadPoolExecutor(CB_CONCURRENCY + 1, thread_name_prefix="callback")
+        self.delayed = DelayedJobs([ q.name for q in queues ])
+        self.host_slots = {}
+        self.host_pending = {}   # host -> jobs picked up, waiting or in flight
+        self.batches = {}
+        self.lock = threading.Lock()
+        self.counters = {
+            'delivered': 0, 'failed': 0, 'retried': 0, 'deferred': 0, 'errors': 0, 'in_flight': 0,
+            'latency': 0., 'max_latency': 0.,
+        }
+
+    def run(self):
+        threading.Thread(target=self.delayed.run, name="delayed", daemon=True).start()
+        asyncio.run(self._loop())
+
+    def count(self, counter, n=1):
+        # the counters are updated from the loop and from the executor threads
+        with self.lock:
+            self.counters[counter] += n
+
+    async def _loop(self):
+        loop = asyncio.get_running_loop()
+        self.slots = asyncio.Semaphore(CB_CONCURRENCY)
+        # limit the jobs picked up and waiting for their host to free up
+        self.pending = asyncio.Semaphore(CB_CONCURRENCY * 10)
+        loop.create_task(self._report())
+        log.info("[{}] callback engine started on {}".format(self.name, [ q.name for q in self.queues ]))
+        while True:
+            await self.pending.acquire()
+            try:
+                job = await loop.run_in_executor(self.executor, self._dequeue)
+            except Exception as e:
+                log.warning("[{}] failed picking up a callback job: {}".format(self.name, e))
+                job = None
+                await asyncio.sleep(1)
+            if job is None:
+                self.pending.release()
+                continue
+            loop.create_task(self._deliver(job))
+
+    def _dequeue(self):
+        try:
+            r = rq.Queue.dequeue_any(self.queues, self.dequeue_timeout, connection=rdbq)
+        except DequeueTimeout:
+            return None
+        return r[0] if r else None
+
+    def batched(self, job):
+        # only the events are batched, for the urls that opted in
+        return job.origin == "QEV" and ("*" in CB_BATCH_URLS or job.args[0] in CB_BATCH_URLS)
+
+    async def _deliver(self, job):
+        loop = asyncio.get_running_loop()
+        if job.func_name != self.cb_func:
+            # not a callback, run it like a worker would
+            try:
+                await loop.run_in_executor(self.executor, self._perform, job)
+            finally:
+                self.pending.release()
+            return
+        if self.batched(job):
+            # never put back in the queue, that would change the order of the events;
+            # the job waits in the batch queue of its url instead, and doesn't hold up
+            # the pick up of the other jobs meanwhile (unless that queue is full)
+            url = job.args[0]
+            if url not in self.batches:
+                self.batches[url] = asyncio.Queue(CB_BATCH_SIZE * 10)
+                loop.create_task(self._batch_sender(url, self.batches[url]))
+            try:
+                await self.batches[url].put(job)
+            finally:
+                self.pending.release()
+            return
+        host = urllib.parse.urlsplit(job.args[0]).netloc
+        if self.host_pending.get(host, 0) >= CB_PER_HOST_PENDING:
+            # the host has its share of the jobs already; this one comes back later, 
+            # instead of taking a slot the other hosts could use
+            try:
+                await loop.run_in_executor(self.executor, self._defer, [ job ], CB_RETRY_DELAY)
+            finally:
+                self.pending.release()
+            return
+        await self._send(job.args[0], job.args[1], [ job ])
+
+    async def _batch_sender(self, url, jobs_queue):
+        # collects the events for a url over a time window, or up to a count, and sends 
+        # them as a single JSON list. there is only one batch in flight for a url, and a
+        # failed batch is retried here, after a backoff, while the events that follow wait
+        # for it: the events for a message reach the app in the order they occurred. this
+        # holds within a callback process, as each process batches the jobs it picks up
+        loop = asyncio.get_running_loop()
+        while True:
+            jobs = [ await jobs_queue.get() ]
+            deadline = loop.time() + CB_BATCH_WINDOW
+            while len(jobs) < CB_BATCH_SIZE:
+                try:
+                    jobs.append(await asyncio.wait_for(jobs_queue.get(), deadline - loop.time()))
+                except asyncio.TimeoutError:
+                    break
+            jdata = "[" + ",".join([ j.args[1] for j in jobs ]) + "]"
+            attempt = 0
+            while True:
+                try:
+                    ok = await self._request(url, jdata, len(jobs))
+                except Exception as e:
+                    log.warning("[{}] failed POSTing the callback batch to {}: {}".format(self.name, url, e))
+                    ok = False
+                attempt += 1
+                if ok or attempt > CB_RETRIES:
+                    break
+                self.count('retried', len(jobs))
+                await asyncio.sleep(self.backoff(attempt))
+            try:
+                await loop.run_in_executor(self.executor, self._finish, jobs, ok)
+            except Exception as e:
+                log.warning("[{}] failed handling the callback jobs for {}: {}".format(self.name, url, e))
+
+    async def _request(self, url, jdata, n):
+        # a single POST, within the slots of its host and of the engine; the n jobs it
+        # carries count as pending for the host meanwhile
+        loop = asyncio.get_running_loop()
+        host = urllib.parse.urlsplit(url).netloc
+        self.host_pending[host] = self.host_pending.get(host, 0) + n
+        try:
+            async with self.host_slots.setdefault(host, asyncio.Semaphore(CB_PER_HOST)):
+                async with self.slots:
+                    self.count('in_flight')
+                    try:
+                        return await loop.run_in_executor(self.executor, self._post, url, jdata)
+                    finally:
+                        self.count('in_flight', -1)
+        finally:
+            self.host_pending[host] -= n
+            if self.host_pending[host] <= 0:
+                del self.host_pending[host]
+                self.host_slots.pop(host, None)
+
+    async def _send(self, url, jdata, jobs):
+        loop = asyncio.get_running_loop()
+        try:
+            ok = await self._request(url, jdata, len(jobs))
+            await loop.run_in_executor(self.executor, self._done, jobs, ok)
+        except Exception as e:
+            log.warning("[{}] failed handling the callback jobs for {}: {}".format(self.name, url, e))
+        finally:
+            for _ in jobs:
+                self.pending.release()
+
+    def _done(self, jobs, ok):
+        if not ok:
+            # retried after a delay growing with the attempts
+            attempt = max(job.meta.get('attempts', 0) for job in jobs) + 1
+            if attempt <= CB_RETRIES:
+                self.count('retried', len(jobs))
+                for job in jobs:
+                    job.meta['attempts'] = attempt
+                    job.save_meta()
+                self._defer(jobs, self.backoff(attempt), counted=True)
+                return
+        self._finish(jobs, ok)
+
+    def _finish(self, jobs, ok):
+        if ok:
+            self.count('delivered', len(jobs))
+            status = JobStatus.FINISHED
+        else:
+            self.count('failed', len(jobs))
+            log.warning("[{}] giving up POSTing {} callbacks to {}".format(self.name, len(jobs), jobs[0].args[0]))
+            status = JobStatus.FAILED
+        for job in jobs:
+            job.set_status(status)
+            job.cleanup(self.result_ttl)
+
+    def _defer(self, jobs, delay, counted=False):
+        p = rdbq.pipeline()
+        for i, job in enumerate(jobs):
+            self.delayed.schedule(job, rq.Queue(job.origin, connection=rdbq), delay + i * 0.001, job.ttl, pipeline=p)
+        p.execute()
+        if not counted:
+            self.count('deferred', len(jobs))
+
+    def _perform(self, job):
+        try:
+            job.set_status(JobStatus.STARTED)
+            job.perform()
+            job.set_status(JobStatus.FINISHED)
+        except Exception as e:
+            log.warning("[{}] job {} failed: {}".format(self.name, job.id, e))
+            log.debug(traceback.format_exc())
+            job.set_status(JobStatus.FAILED)
+        job.cleanup(self.result_ttl)
+
+    @staticmethod
+    def backoff(attempt):
+        d = min(CB_MAX_RETRY_DELAY, CB_RETRY_DELAY * (2 ** (attempt - 1)))
+        return d / 2 + random.uniform(0, d / 2)
+
+    def _post(self, url, jdata):
+        started = time.time()
+        try:
+            rp = self.http.post(url, headers={ 'User-Agent': USER_AGENT }, 
+                json=json.loads(jdata), timeout=CB_TIMEOUT
+            )
+            ok = rp.status_code < 400
+            if not ok:
+                log.warning(">>>> [callback] POSTing to {} failed with status {}: {}"
+                    .format(url, rp.status_code, rp.text)
+                )
+        except Exception as e:
+            log.warning(">>>> [callback] POSTing to {} failed: {}".format(url, e))
+            ok = False
+        latency = time.time() - started
+        with self.lock:
+            self.counters['latency'] += latency
+            self.counters['max_latency'] = max(self.counters['max_latency'], latency)
+            if not ok:
+                self.counters['errors'] += 1
+        return ok
+
+    def stats(self):
+        with self.lock:
+            c = dict(self.counters)
+        requests = self.http.requests
+        c['avg_latency'] = (c.pop('latency') / requests) if requests else 0
+        c.update(self.http.stats())
+        return c
+
+    async def _report(self):
+        while True:
+            await asyncio.sleep(self.stats_interval)
+            st = self.stats()
+            log.info("[{}] callback stats: {}".format(self.name, st))
+            try:
+                rdbq.hmset('cbstat-' + self.name, st)
+                rdbq.expire('cbstat-' + self.name, 3 * self.stats_interval)
+            except Exception as e:
+                log.warning("[{}] failed storing callback stats: {}".format(self.name, e))
@@ -1,13 +1,10 @@
-import requests
-from rq import Connection, Worker
+
+import rq
 
 from constants import *
 from backend.logger import log
 from backend.storage import rdbq
-import backend.util
-
-with Connection(connection=rdbq):
-    w = Worker([ 'QMO', 'QEV' ])
-    w.work()
-
+from backend.webhook import WebhookEngine
 
+engine = WebhookEngine([ rq.Queue('QMO', connection=rdbq), rq.Queue('QEV', connection=rdbq) ])
+engine.run()
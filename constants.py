@@ -40,6 +40,7 @@ cfg.read(CFG_ROOT + "mmsgw.conf")
 API_URL = cfg['general']['api_url']
 API_DEV_PORT = int(cfg['general'].get('api_dev_port', 8080))
 
+MM7_MAX_REQUEST_SIZE = int(cfg['general'].get('mm7_max_request_size', 10 * 1024 * 1024))
 TMP_MMS_DIR = cfg['general'].get("tmp_dir", "/tmp/mms/")
 if not TMP_MMS_DIR.endswith("/"):
     TMP_MMS_DIR += "/"
@@ -48,11 +49,27 @@ if not os.path.isdir(TMP_MMS_DIR):
 
 MMS_TTL = int(cfg['general'].get('mms_ttl', 4 * 3600))
 MMS_TEMPLATE_TTL = int(cfg['general'].get('mms_template_ttl', 24 * 3600))
+TEMPLATE_CACHE_ITEMS = int(cfg['general'].get('template_cache_items', 10000))
+TEMPLATE_CACHE_TTL = int(cfg['general'].get('template_cache_ttl', 300))
 
 DEFAULT_GATEWAY = cfg['general'].get('default_gateway', "provider")
 GW_HEARTBEAT_TIMER = int(cfg['general'].get('gateway_heartbeat_interval', 30))
 GW_HEARTBEATS = int(cfg['general'].get('gateway_max_missed_heartbeats', 10))
 MAX_GW_RETRIES = int(cfg['general'].get('max_gateway_retries', 5))
+GW_RETRY_DELAY = float(cfg['general'].get('gateway_retry_delay', 2))
+GW_MAX_RETRY_DELAY = float(cfg['general'].get('gateway_max_retry_delay', 300))
+
+CB_CFG = cfg['callbacks'] if cfg.has_section('callbacks') else {}
+CB_CONCURRENCY = int(CB_CFG.get('concurrency', 20))
+CB_PER_HOST = int(CB_CFG.get('per_host', 5))
+CB_PER_HOST_PENDING = int(CB_CFG.get('per_host_pending', 4 * CB_PER_HOST))
+CB_TIMEOUT = float(CB_CFG.get('timeout', 10))
+CB_RETRIES = int(CB_CFG.get('retries', 5))
+CB_RETRY_DELAY = float(CB_CFG.get('retry_delay', 1))
+CB_MAX_RETRY_DELAY = float(CB_CFG.get('max_retry_delay', 60))
+CB_BATCH_URLS = [ u.strip() for u in CB_CFG.get('batch_urls', "").split(",") if u.strip() ]
+CB_BATCH_SIZE = int(CB_CFG.get('batch_size', 100))
+CB_BATCH_WINDOW = float(CB_CFG.get('batch_window', 1))
 
 STORAGE_CONN = cfg['message_storage']
 QUEUE_CONN = cfg['queue_storage']
@@ -3,11 +3,12 @@ import configparser
 import socket
 import os
 import threading
-from rq import Connection, Worker
+import rq
 
 from constants import *
 from backend.logger import log
 from backend.storage import rdbq
+from backend.engine import JobEngine
 import models.gateway
 
 
@@ -40,7 +41,11 @@ elif gw_type == "MM7":
 else:
     print((sys.argv[len(sys.argv) - 1] + "Gateway protocol unsupported or missing; use MM4 or MM7.\n"))
     exit()
-gw.config(cfg)
+try:
+    gw.config(cfg)
+except ValueError as e:
+    print("Configuration error: {}. This gateway instance will not start.\n".format(e))
+    exit()
 if not gw.start():
     print("SMTP connection error, check logs. This gateway instance will not start.\n")
     exit()
@@ -52,8 +57,30 @@ if not burst and cfg['outbound'].get('heartbeat') is not None:
     log.debug("[{}] Setting up heartbeat".format(gwid))
     hb(gw)
 
-with Connection(connection=rdbq):
-    w = Worker(['QTX-' + gw_group, 'QRX-' + gw_group, 'QEV-' + gw_group], name=gwid)
-    w.work()
+# rescheduled jobs wait in the delayed set of their queue, until their retry time comes
+threading.Thread(target=gw.delayed.run, name="delayed", daemon=True).start()
 
+# the transmission queue is split in priority lanes; the engines share the executors 
+# among the lanes according to their weights, whatever the number of executors, so 
+# lower priority messages are delayed, but never starved
+lanes = [ q for q, _ in sorted(gw.lanes, key=lambda l: -l[1]) ]
+weights = { q.name: w for q, w in gw.lanes }
+queues = lanes + [ rq.Queue(q, connection=rdbq) for q in ( 'QRX-' + gw_group, 'QEV-' + gw_group ) ]
+if gw.executors > 1:
+    # all the queues are handled by an engine running that many jobs at the same time, 
+    # on threads sharing this gateway instance: heartbeat, health state and connections
+    engine = JobEngine(gwid, queues, gw.executors, weights)
+    engine.run()
+    exit()
 
+if gw_type == "MM7" and gw.concurrency > 1:
+    # transmissions are handled by an engine that keeps many of them in flight, the 
+    # other queues by an engine running one job at a time
+    engine = JobEngine(gwid, lanes, gw.concurrency, weights)
+    threading.Thread(target=engine.run, name="submit", daemon=True).start()
+    engine = JobEngine(gwid + ":rx", queues[len(lanes):], 1)
+else:
+    # one job at a time; jobs are executed in this process, not in a forked child, so 
+    # that they share the gateway connection and the templates and media caches
+    engine = JobEngine(gwid, queues, 1, weights)
+engine.run()
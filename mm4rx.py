@@ -1,12 +1,15 @@
 import os
 import sys
+import time
 import shutil
-import asyncore
+import socket
+import asyncio
+import contextlib
 import uuid
 import rq
 import configparser
 import pyinotify
-from smtpd import SMTPServer
+from concurrent.futures import ThreadPoolExecutor
 import email, email.utils
 
 import traceback
@@ -15,89 +18,414 @@ from constants import *
 from backend.logger import log
 from backend.storage import rdbq
 from backend.util import repo
+from backend.mime import read_headers
+from backend.routing import RoutingIndex
 
 
-def dispatch(content, sender, receivers, source=None):
-
-    log.info(">>>> {} inbound on MM4 interface - From: {}, To: {}, length: {}"
-        .format(source or "", sender, receivers, len(content))
-    )
-    log.debug(">>>> content: {}{}"
-        .format(content[:4096], ("..." if len(content) > 4096 else ""))
-    )
-    if len(content) > 4096:
-        log.debug(">>>> ...{}".format(content[-256:]))
-
-    # get a gateway that can handle the message; preference is to search 
-    # by receiver address first, by sending host next, and by sender address last
-    gw = \
-        cfg['receivers'].get(email.utils.parseaddr(receivers[0])[1]) or \
-        cfg['peers'].get(source[0]) if source is not None else None or \
-        cfg['senders'].get(email.utils.parseaddr(sender)[1])
-    if gw is None:
-        log.warning(">>>> no gateway to process this email")
-        return "555 MAIL FROM/RCPT TO parameters not recognized"
-
-    mm4rx_id = str(uuid.uuid4()).replace("-", "")
-    
-    # move content as file to be processed
-    fn = repo(TMP_MMS_DIR, mm4rx_id + ".mm4")
-    if cfg['general'].get('smtp_host'):
-        with open(fn, "wb") as fh:
-            fh.write(content)
-
-    # post a task for the gateway parser
-    q_rx = rq.Queue("QRX-" + gw, connection=rdbq)
-    q_rx.enqueue_call(
-        func='models.gateway.inbound', args=( mm4rx_id + ".mm4", ),
+def inbound_job(mm4rx_id):
+    return rq.Queue.prepare_data('models.gateway.inbound', args=( mm4rx_id + ".mm4", ),
         job_id=mm4rx_id,
         meta={ 'retries': MAX_GW_RETRIES },
         ttl=30
     )
-    log.info(">>>> message {}, queued for processing by gateway {}".format(mm4rx_id, gw))
 
-    return None
+
+def enqueue_many(batch):
+    # queue a batch of ( gateway, id ) received messages
+    jobs = {}
+    for gw, mm4rx_id in batch:
+        jobs.setdefault(gw, []).append(inbound_job(mm4rx_id))
+    for gw, gw_jobs in jobs.items():
+        rq.Queue("QRX-" + gw, connection=rdbq).enqueue_many(gw_jobs)
+        log.info(">>>> {} messages queued for processing by gateway {}".format(len(gw_jobs), gw))
+
+
+def enqueue(gw, mm4rx_id):
+    # post a task for the gateway parser
+    enqueue_many([ ( gw, mm4rx_id ) ])
 
 
-class MaildirEventHandler(pyinotify.ProcessEvent):
+class SpoolWatcher(pyinotify.ProcessEvent):
+# takes over the files showing up in the spool directory: the files already there when
+# starting, and those arriving afterwards. a file is claimed by renaming it, so when
+# several instances watch the same directory, only one of them gets it; then only its
+# headers are read, to find the gateway, and it is moved to the repo as it is. the
+# files are handled by the executor threads, and the jobs are queued in batches
 
     spool_dir = None
+    executor = None
+    queue = None
+    claim_timeout = 300
+
+    def my_init(self, spool_dir, executor, queue, claim_timeout=300):
+        self.spool_dir = spool_dir
+        self.executor = executor
+        self.queue = queue
+        self.claim_timeout = claim_timeout
 
     def process_IN_CLOSE_WRITE(self, ev):
-        self._process(ev)
+        self.executor.submit(self._process, ev.name)
     def process_IN_MOVED_TO(self, ev):
-        self._process(ev)
+        self.executor.submit(self._process, ev.name)
 
-    def _process(self, ev):
-        # change name of the file asap, to minimize the probability of racing conditions 
-        # when processing across multiple instances of the app
-        if ev.name.startswith("_"): return
-        fn = self.spool_dir + "_" + ev.name
+    def backlog(self):
+        # files delivered while no instance was watching, and files claimed a while ago by
+        # an instance that didn't get to move them (it died meanwhile), given up again
+        n = 0
+        stale = 0
+        with os.scandir(self.spool_dir) as it:
+            for entry in it:
+                if not entry.is_file():
+                    continue
+                name = entry.name
+                if name.startswith("_"):
+                    try:
+                        if time.time() - entry.stat().st_mtime < self.claim_timeout:
+                            continue
+                        os.rename(self.spool_dir + name, self.spool_dir + name[1:])
+                    except OSError:
+                        # taken care of by another instance
+                        continue
+                    name = name[1:]
+                    stale += 1
+                self.executor.submit(self._process, name)
+                n += 1
+        log.warning(">>>> MM4 file daemon found {} files in {}, {} of them claimed but not processed"
+            .format(n, self.spool_dir, stale)
+        )
+
+    def _process(self, name):
+        if name.startswith("_"): return
+        fn = self.spool_dir + "_" + name
         try:
-            shutil.move(ev.pathname, fn)
-        except Exception as e:
-            log.warning(">>>> possible MM4 file watcher racing condition: " + str(e))
+            os.rename(self.spool_dir + name, fn)
+            # the claim is timed from now, see backlog()
+            os.utime(fn)
+        except FileNotFoundError:
+            # claimed by another instance, or seen twice (backlog and event)
+            return
+        except OSError as e:
+            log.warning(">>>> MM4 file watcher failed to claim {}: {}".format(name, e))
             return
-        # parse the file content to get the from and to addresses
         try:
             with open(fn, "rb") as fh:
-                msg = email.message_from_binary_file(fh)
-                dispatch(fh.read(),
-                    msg.get('from'), 
-                    email.utils.getaddresses(msg.get_all('to')) 
-                )
-        except email.errors.MessageParseError as me:
-            log.warning(">>>> MM4 file watcher failed to parse {}: {}"
-                .format(spool_fn, me)
+                msg = read_headers(fh)
+            receivers = [ a for _, a in email.utils.getaddresses(msg.get_all('to', [])) ]
+            sender = msg.get('from', "")
+            log.info(">>>> {} inbound on MM4 spool - From: {}, To: {}".format(name, sender, receivers))
+            gw = routes.lookup(sender, receivers[0]) if receivers else None
+            if gw is None:
+                log.warning(">>>> no gateway to process {}".format(name))
+                os.remove(fn)
+                return
+            mm4rx_id = str(uuid.uuid4()).replace("-", "")
+            shutil.move(fn, repo(TMP_MMS_DIR, mm4rx_id + ".mm4"))
+            self.queue.put(gw, mm4rx_id)
+        except Exception as e:
+            log.debug(traceback.format_exc())
+            log.warning(">>>> MM4 file watcher failed on {}: {}".format(name, e))
+
+
+class BatchQueue(object):
+# the jobs for the received messages, queued in batches: one redis round trip for the 
+# jobs collected within a short window, instead of one for each
+
+    size = 100
+    window = 0.05
+
+    def __init__(self, loop, executor, size=100, window=0.05):
+        self.loop = loop
+        self.executor = executor
+        self.size = size
+        self.window = window
+        self.pending = asyncio.Queue()
+
+    def put(self, gw, mm4rx_id):
+        # called from any thread
+        self.loop.call_soon_threadsafe(self.pending.put_nowait, ( gw, mm4rx_id ))
+
+    async def run(self):
+        while True:
+            batch = [ await self.pending.get() ]
+            deadline = self.loop.time() + self.window
+            while len(batch) < self.size:
+                try:
+                    batch.append(await asyncio.wait_for(self.pending.get(), deadline - self.loop.time()))
+                except asyncio.TimeoutError:
+                    break
+            try:
+                await self.loop.run_in_executor(self.executor, enqueue_many, batch)
+            except Exception as e:
+                log.critical(">>>> failed queueing {} received messages: {}".format(len(batch), e))
+
+
+class MM4SMTPServer(object):
+# SMTP listener for the carrier MMSCs, running many sessions at the same time on an
+# asyncio loop. the DATA of a message is written to its repo file in blocks, as it
+# arrives, and the file and redis work is done by executor threads, so the loop never
+# blocks. a peer is only allowed so many sessions, and so many messages being received,
+# at the same time: sessions over the limit are turned away with a 421, so the peer
+# retries later, and transfers over the limit wait for their turn before the 354
+
+    hostname = ""
+    timeout = 300
+    max_sessions = 200
+    max_peer_sessions = 20
+    max_peer_transfers = 5
+    max_message_size = 0
+    max_recipients = 1000
+    write_size = 64 * 1024
+
+    def __init__(self, cfg, executor):
+        self.hostname = cfg.get('smtp_hostname', socket.getfqdn())
+        self.timeout = int(cfg.get('session_timeout', 300))
+        self.max_sessions = int(cfg.get('max_sessions', 200))
+        self.max_peer_sessions = int(cfg.get('max_peer_sessions', 20))
+        self.max_peer_transfers = int(cfg.get('max_peer_transfers', 5))
+        self.max_message_size = int(cfg.get('max_message_size', 0))
+        self.executor = executor
+        self.sessions = {}   # peer -> sessions
+        self.transfers = {}  # peer -> [ semaphore, sessions using it ]
+
+    async def session(self, reader, writer):
+        peer = writer.get_extra_info('peername') or ( "", 0 )
+        total = sum(self.sessions.values())
+        if total >= self.max_sessions or self.sessions.get(peer[0], 0) >= self.max_peer_sessions:
+            log.warning(">>>> {} session refused, {} sessions open, {} from this peer"
+                .format(peer[0], total, self.sessions.get(peer[0], 0))
             )
+            writer.write(b"421 4.7.0 Too many connections, try again later\r\n")
+            await self._close(writer)
+            return
+        self.sessions[peer[0]] = self.sessions.get(peer[0], 0) + 1
+        try:
+            await SMTPSession(self, reader, writer, peer).run()
+        except (ConnectionError, asyncio.IncompleteReadError) as e:
+            log.info(">>>> {} session lost: {}".format(peer[0], e))
         except Exception as e:
+            log.warning(">>>> {} session failed: {}".format(peer[0], e))
             log.debug(traceback.format_exc())
-            log.warning(">>>> MM4 file watcher failed: {}".format(e))
+        finally:
+            self.sessions[peer[0]] -= 1
+            if self.sessions[peer[0]] == 0:
+                del self.sessions[peer[0]]
+            await self._close(writer)
+
+    @contextlib.asynccontextmanager
+    async def transfer_slot(self, peer):
+        # the semaphore of a peer lives as long as some of its sessions use it or wait for it
+        slot = self.transfers.get(peer[0])
+        if slot is None:
+            slot = self.transfers[peer[0]] = [ asyncio.Semaphore(self.max_peer_transfers), 0 ]
+        slot[1] += 1
+        try:
+            async with slot[0]:
+                yield
+        finally:
+            slot[1] -= 1
+            if slot[1] == 0:
+                del self.transfers[peer[0]]
+
+    async def _close(self, writer):
+        try:
+            writer.close()
+            await writer.wait_closed()
+        except Exception:
+            pass
 
 
-class MM4SMTPServer(SMTPServer):
-    def process_message(self, sender_host, from_addr, to_addr, data, **kwargs):
-        return dispatch(data, from_addr, to_addr, sender_host)
+class SMTPSession(object):
+
+    def __init__(self, server, reader, writer, peer):
+        self.server = server
+        self.reader = reader
+        self.writer = writer
+        self.peer = peer
+        self.helo = None
+        self.mail_from = None
+        self.rcpt_to = []
+        self.gateway = None
+
+    async def reply(self, *lines):
+        # multiline replies get the dash after the code, except for the last line
+        for i, l in enumerate(lines):
+            if i < len(lines) - 1:
+                l = l[:3] + "-" + l[4:]
+            self.writer.write((l + "\r\n").encode())
+        await self.writer.drain()
+
+    async def readline(self):
+        return await asyncio.wait_for(self.reader.readline(), self.server.timeout)
+
+    async def run(self):
+        log.debug(">>>> {} session started".format(self.peer[0]))
+        await self.reply("220 {} ESMTP {}".format(self.server.hostname, USER_AGENT))
+        while True:
+            try:
+                line = await self.readline()
+            except asyncio.TimeoutError:
+                await self.reply("421 4.4.2 Idle for too long, closing connection")
+                return
+            except ValueError:
+                await self.reply("500 5.5.2 Line too long")
+                continue
+            if not line:
+                return
+            cmd, _, arg = line.decode(errors="replace").strip().partition(" ")
+            handler = getattr(self, "smtp_" + cmd.upper(), None)
+            if handler is None:
+                await self.reply("502 5.5.2 Command not recognized")
+            elif await handler(arg.strip()) is False:
+                return
+
+    def _reset(self):
+        self.mail_from = None
+        self.rcpt_to = []
+        self.gateway = None
+
+    def _address(self, arg, prefix):
+        # the address in "FROM:<addr> PARAM=VALUE ...", and the parameters
+        if not arg.upper().startswith(prefix):
+            return None, []
+        addr, _, params = arg[len(prefix):].strip().partition(" ")
+        return addr.strip("<>"), params.split()
+
+    async def smtp_HELO(self, arg):
+        self.helo = arg
+        self._reset()
+        await self.reply("250 " + self.server.hostname)
+
+    async def smtp_EHLO(self, arg):
+        self.helo = arg
+        self._reset()
+        await self.reply(
+            "250 " + self.server.hostname,
+            "250 SIZE {}".format(self.server.max_message_size),
+            "250 8BITMIME",
+            "250 PIPELINING",
+        )
+
+    async def smtp_MAIL(self, arg):
+        if self.mail_from is not None:
+            await self.reply("503 5.5.1 Sender already specified")
+            return
+        addr, params = self._address(arg, "FROM:")
+        if addr is None:
+            await self.reply("501 5.5.4 Syntax: MAIL FROM:<address>")
+            return
+        for p in params:
+            k, _, v = p.partition("=")
+            if k.upper() == "SIZE" and v.isdigit() and self.server.max_message_size and \
+                int(v) > self.server.max_message_size:
+                await self.reply("552 5.3.4 Message size exceeds fixed limit")
+                return
+        self.mail_from = addr
+        await self.reply("250 2.1.0 OK")
+
+    async def smtp_RCPT(self, arg):
+        if self.mail_from is None:
+            await self.reply("503 5.5.1 Need MAIL before RCPT")
+            return
+        addr, _ = self._address(arg, "TO:")
+        if not addr:
+            await self.reply("501 5.5.4 Syntax: RCPT TO:<address>")
+            return
+        if len(self.rcpt_to) >= self.server.max_recipients:
+            await self.reply("452 4.5.3 Too many recipients")
+            return
+        # unroutable mail is refused here, before its DATA is received; the message goes
+        # to the gateway of its first recipient
+        gw = routes.lookup(self.mail_from, addr, [ n for n in ( self.peer[0], self.helo ) if n ])
+        if gw is None:
+            log.warning(">>>> {} no gateway for mail from {} to {}".format(self.peer[0], self.mail_from, addr))
+            await self.reply("550 5.1.1 No gateway for this recipient")
+            return
+        if self.gateway is None:
+            self.gateway = gw
+        self.rcpt_to.append(addr)
+        await self.reply("250 2.1.5 OK")
+
+    async def smtp_DATA(self, arg):
+        if not self.rcpt_to:
+            await self.reply("503 5.5.1 Need RCPT before DATA")
+            return
+        async with self.server.transfer_slot(self.peer):
+            return await self._data()
+
+    async def _data(self):
+        loop = asyncio.get_running_loop()
+        ex = self.server.executor
+        mm4rx_id = str(uuid.uuid4()).replace("-", "")
+        fn = await loop.run_in_executor(ex, repo, TMP_MMS_DIR, mm4rx_id + ".mm4")
+        fh = await loop.run_in_executor(ex, open, fn, "wb")
+        await self.reply("354 End data with <CR><LF>.<CR><LF>")
+
+        # the lines are written in blocks, while the next block is being received
+        size = 0
+        too_big = False
+        lines = []
+        buffered = 0
+        writing = None
+        try:
+            while True:
+                line = await self.readline()
+                if not line:
+                    raise ConnectionError("connection closed during DATA")
+                if line in ( b".\r\n", b".\n" ):
+                    break
+                if line.startswith(b"."):
+                    line = line[1:]
+                size += len(line)
+                if too_big or (self.server.max_message_size and size > self.server.max_message_size):
+                    too_big = True
+                    continue
+                lines.append(line)
+                buffered += len(line)
+                if buffered >= self.server.write_size:
+                    if writing:
+                        await writing
+                    writing = loop.run_in_executor(ex, fh.writelines, lines)
+                    lines = []
+                    buffered = 0
+            if writing:
+                await writing
+            await loop.run_in_executor(ex, fh.writelines, lines)
+        except BaseException:
+            await loop.run_in_executor(ex, self._discard, fh, fn)
+            raise
+        await loop.run_in_executor(ex, fh.close)
+
+        log.info(">>>> {} inbound on MM4 interface - From: {}, To: {}, length: {}"
+            .format(self.peer[0], self.mail_from, self.rcpt_to, size)
+        )
+        if too_big:
+            await loop.run_in_executor(ex, self._discard, None, fn)
+            log.warning(">>>> {} message of {} bytes refused, too large".format(self.peer[0], size))
+            await self.reply("552 5.3.4 Message size exceeds fixed limit")
+        else:
+            await loop.run_in_executor(ex, enqueue, self.gateway, mm4rx_id)
+            await self.reply("250 2.0.0 OK queued as " + mm4rx_id)
+        self._reset()
+
+    def _discard(self, fh, fn):
+        if fh:
+            fh.close()
+        if os.path.exists(fn):
+            os.remove(fn)
+
+    async def smtp_RSET(self, arg):
+        self._reset()
+        await self.reply("250 2.0.0 OK")
+
+    async def smtp_NOOP(self, arg):
+        await self.reply("250 2.0.0 OK")
+
+    async def smtp_VRFY(self, arg):
+        await self.reply("252 2.5.2 Cannot VRFY user")
+
+    async def smtp_QUIT(self, arg):
+        await self.reply("221 2.0.0 Bye")
+        return False
 
 
 if len(sys.argv) < 2:
@@ -105,28 +433,45 @@ if len(sys.argv) < 2:
     exit()
 cfg = configparser.ConfigParser()
 cfg.read(sys.argv[len(sys.argv) - 1])
+routes = RoutingIndex(cfg)
 
 TMP_MMS_DIR = cfg['general'].get('tmp_dir', "/tmp/mms/")
 if not TMP_MMS_DIR.endswith("/"):
     TMP_MMS_DIR += "/"
 
-bind_host = cfg['general'].get('smtp_host', '')
-bind_port = int(cfg['general'].get('smtp_port', 25))
-if bind_host:
-    _1 = MM4SMTPServer(( bind_host, bind_port ), None)
-    log.warning(">>>> MM4 SMTP daemon started, listening on {}:{}".format(bind_host, bind_port))
-
-spool = cfg['general'].get('spool_dir')
-if spool:
-    wm = pyinotify.WatchManager()
-    h = MaildirEventHandler()
-    h.spool_dir = spool
-    notifier = pyinotify.AsyncNotifier(wm, h)
-    _2 = wm.add_watch(spool, 
-        pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO
-#        exclude_filter=pyinotify.ExcludeFilter([ spool + "_*" ])
-    )
-    log.warning(">>>> MM4 file daemon started, watching " + spool)
 
-asyncore.loop()
+async def main():
+    loop = asyncio.get_running_loop()
+    # file and redis work goes to these threads
+    executor = ThreadPoolExecutor(int(cfg['general'].get('workers', 8)), thread_name_prefix="mm4rx")
+
+    bind_host = cfg['general'].get('smtp_host', '')
+    bind_port = int(cfg['general'].get('smtp_port', 25))
+    if bind_host:
+        smtp = MM4SMTPServer(cfg['general'], executor)
+        await asyncio.start_server(smtp.session, bind_host, bind_port)
+        log.warning(">>>> MM4 SMTP daemon started, listening on {}:{}".format(bind_host, bind_port))
+
+    spool = cfg['general'].get('spool_dir')
+    if spool:
+        if not spool.endswith("/"):
+            spool += "/"
+        queue = BatchQueue(loop, executor, 
+            int(cfg['general'].get('spool_batch_size', 100)), 
+            float(cfg['general'].get('spool_batch_window', 0.05))
+        )
+        loop.create_task(queue.run())
+        wm = pyinotify.WatchManager()
+        watcher = SpoolWatcher(spool_dir=spool, executor=executor, queue=queue, 
+            claim_timeout=int(cfg['general'].get('spool_claim_timeout', 300))
+        )
+        notifier = pyinotify.AsyncioNotifier(wm, loop, default_proc_fun=watcher)
+        _2 = wm.add_watch(spool, pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO)
+        log.warning(">>>> MM4 file daemon started, watching " + spool)
+        # the backlog is scanned after the watch is set up, so no file falls in between
+        watcher.backlog()
+
+    await asyncio.Event().wait()
+
 
+asyncio.run(main())
@@ -5,8 +5,12 @@ import datetime
 import iso8601
 import uuid
 import base64
+import hashlib
 import json
+import bottle
 import rq
+from rq.job import Job, JobStatus
+from rq.exceptions import NoSuchJobError
 import requests
 import xmltodict
 
@@ -19,21 +23,63 @@ import mimetypes
 from email.mime.base import MIMEBase
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
-from email.mime.image import MIMEImage
-from email.mime.audio import MIMEAudio
 
 from constants import *
 from backend.logger import log
-from backend.util import find_in_dict, download_to_file, repo
+from backend.util import find_in_dict, download_to_file, repo, tx_queue_name
 from backend.storage import rdb, rdbq
+from backend.throttle import TokenBucket
+from backend.cache import LRUCache
+from backend.pool import SMTPPool, HTTPPool
+from backend.engine import DelayedJobs
+from backend.mime import WireBody, CRLF, wire, pre_encoded, smtp_send, DataInterrupted, MIMEFile
 import models.message
 import models.template
 
 
 TOP_PART_BOUNDARY = "========Top-Part-Boundary"
+CONTENT_PART_BOUNDARY = "========Content-Part-Boundary"
 
 THIS_GW = None
 
+# delete a media download lease, only if still held by the gateway instance in ARGV[1]
+RELEASE_LEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class MediaPending(Exception):
+# the media content of a message part is being downloaded by another gateway instance
+    pass
+
+
+@bottle.get(URL_ROOT + "gateway/<group>")
+def get_gateway_status(group):
+    executors = {}
+    for k in rdbq.scan_iter('gwexec-' + group + ':*'):
+        executors[k.decode()[7:]] = { 
+            t.decode(): json.loads(v) for t, v in rdbq.hgetall(k).items() 
+        }
+    render_cache = {}
+    for k in rdbq.scan_iter('gwcache-' + group + ':*'):
+        render_cache[k.decode()[8:]] = { t.decode(): int(v) for t, v in rdbq.hgetall(k).items() }
+    queues = {}
+    delayed = {}
+    for q in [ tx_queue_name(group, pri) for pri in ACCEPTED_MESSAGE_PRIORITIES ] + [ "QRX-" + group, "QEV-" + group ]:
+        queues[q] = rq.Queue(q, connection=rdbq).count
+        delayed[q] = DelayedJobs.count(q)
+    return {
+        'group': group,
+        'tps_tokens': TokenBucket(group, 0).level(),
+        'executors': executors,
+        'render_cache': render_cache,
+        'queues': queues,
+        'delayed': delayed,
+    }
+
 def send_mms(txid):
     tx = models.message.MMSMessage(txid)
     if tx is None:
@@ -54,44 +100,59 @@ def send_mms(txid):
         # this shouldnt happen: if the heartbeat key is gone, the gateway instance is dead
         # (if it does happen, then it's just my bad logic)
         log.alarm("[{}] gateway still alive, despite missing all heartbeats".format(gw.gwid))
-        reschedule(this_job, gw.q_tx)
+        reschedule(this_job)
     elif heartbeats_left < (GW_HEARTBEATS - 1):
         # is this gateway is probably not healthy enough to process the job, have it skip it
         log.warning("[{}] gateway in bad state when attempted transmission {}, rescheduling"
             .format(gw.gwid, txid)
         )
-        reschedule(this_job, gw.q_tx)
+        reschedule(this_job)
     else:
-
-        try:
-            log.debug("[{}] {} creating {} transmission image".format(gw.gwid, txid, gw.protocol))
-            m = gw.render(tx)
-            if m:
-                log.debug("[{}] {} prepared for transmission".format(gw.gwid, txid))
-                if gw.protocol == "MM4":
-                    src_addr = gw.origin_prefix + tx.origin + gw.origin_suffix
-                    if "@" not in src_addr:
-                        src_addr += "@" + gw.local_domain
-                    dest_addr = list([gw.dest_prefix + a + gw.dest_suffix + 
-                        (("@" + gw.remote_domain) if "@" not in gw.dest_suffix else "") for a in tx.destination | tx.cc | tx.bcc])
-                    ret_code, ret_desc = gw.send_to_mmsc(m, txid, src_addr, dest_addr)
-                else:
-                    ret_code, ret_desc = gw.send_to_mmsc(m, txid)
-                if ret_code is None:
-                    tx.set_state([], "SENT", "", "", gw.gwid, gw.events_url, ret_desc)
-                    return
+        # the recipients of the message, and maybe of other messages waiting in the queue, 
+        # are planned in submissions of the size the peer accepts
+        for sub in gw.plan(tx, this_job):
+            try:
+                log.debug("[{}] {} creating {} transmission image".format(gw.gwid, sub.id, gw.protocol))
+                m = gw.render(sub)
+                if m:
+                    log.debug("[{}] {} prepared for transmission".format(gw.gwid, sub.id))
+                    gw.throttle(sub.id)
+                    if gw.protocol == "MM4":
+                        src_addr = gw.origin_prefix + sub.origin + gw.origin_suffix
+                        if "@" not in src_addr:
+                            src_addr += "@" + gw.local_domain
+                        dest_addr = list([gw.dest_prefix + a + gw.dest_suffix + 
+                            (("@" + gw.remote_domain) if "@" not in gw.dest_suffix else "") for a in sub.recipients()])
+                        ret_code, ret_desc = gw.send_to_mmsc(m, sub.id, src_addr, dest_addr)
+                    else:
+                        ret_code, ret_desc = gw.send_to_mmsc(m, sub.id)
+                    if ret_code is not None:
+                        log.debug("[{}] {} transmission error {}: {}".format(gw.gwid, sub.id, ret_code, ret_desc))
                 else:
-                    log.debug("[{}] {} transmission error {}: {}".format(gw.gwid, txid, ret_code, ret_desc))
-            else:
-                ret_code, ret_desc = "1", "internal error: failed to properly render message" 
-        except Exception as ex:
-            log.info("[{}] {} gateway error: {}".format(gw.gwid, txid, traceback.format_exc()))
-            ret_code, ret_desc = "2", "internal error: {}".format(ex) 
+                    ret_code, ret_desc = "1", "internal error: failed to properly render message" 
+            except MediaPending as mpe:
+                # not a failure, try again later, maybe on another gateway instance
+                log.info("[{}] {} rescheduling, media not available yet: {}".format(gw.gwid, sub.id, mpe))
+                sub.reschedule(media_pending=True)
+                reschedule(this_job, media_pending=True)
+                return
+            except Exception as ex:
+                log.info("[{}] {} gateway error: {}".format(gw.gwid, sub.id, traceback.format_exc()))
+                ret_code, ret_desc = "2", "internal error: {}".format(ex) 
 
-        tx.set_state([], "FAILED", ret_code, ret_desc, gw.gwid, gw.events_url)
-        if len(str(ret_code)) > 1:
-            # only reschedule for external, environmental errors
-            reschedule(this_job, gw.q_tx)
+            if ret_code is None:
+                sub.set_state("SENT", "", "", gw.gwid, gw.events_url, ret_desc)
+            else:
+                sub.set_state("FAILED", ret_code, ret_desc, gw.gwid, gw.events_url)
+                if len(str(ret_code)) > 1:
+                    # only reschedule for external, environmental errors; the recipients 
+                    # already done are skipped on the next attempt
+                    sub.reschedule()
+                    reschedule(this_job)
+                    return
+            sub.finish()
+            this_job.meta['done'] = this_job.meta.get('done', []) + sub.recipients(tx)
+            this_job.save_meta()
 
 
 def inbound(content_fn, meta_xml=None):
@@ -119,21 +180,23 @@ def inbound(content_fn, meta_xml=None):
     if content_fn:
         try:
             fn = gw.tmp_dir + content_fn[0:2] + "/" + content_fn
-            with open(fn, "r") as fh:
-                e = email.message_from_file(fh)
-                if gw.protocol == "MM4":
-                    if e["X-Mms-3GPP-MMS-Version"] is None:
-                        log.warning("[{}] {} not an MM4 message".format(gw.gwid, jid))
-                        return
-                    if e["X-Mms-Message-Type"] is None:
-                        log.warning("[{}] {} missing MM4 message type".format(gw.gwid, jid))
-                        return
-                    handler = MM4_TYPE.get(e["X-Mms-Message-Type"].lower())
-                elif gw.protocol == "MM7":
-                    meta = ET.fromstring(meta_xml)
-                    ns = meta.tag[meta.tag.find("{"):meta.tag.find("}")+1]
-                    tag = meta.tag.replace(ns, "")
-                    handler = MM7_TYPE.get(tag.lower())
+            # only the headers are parsed here; the parts are read from the file later, 
+            # one at a time
+            content = MIMEFile(fn)
+            e = content.headers
+            if gw.protocol == "MM4":
+                if e["X-Mms-3GPP-MMS-Version"] is None:
+                    log.warning("[{}] {} not an MM4 message".format(gw.gwid, jid))
+                    return
+                if e["X-Mms-Message-Type"] is None:
+                    log.warning("[{}] {} missing MM4 message type".format(gw.gwid, jid))
+                    return
+                handler = MM4_TYPE.get(e["X-Mms-Message-Type"].lower())
+            elif gw.protocol == "MM7":
+                meta = ET.fromstring(meta_xml)
+                ns = meta.tag[meta.tag.find("{"):meta.tag.find("}")+1]
+                tag = meta.tag.replace(ns, "")
+                handler = MM7_TYPE.get(tag.lower())
         except IOError as ioe:
             log.info("[{}] {} error reading MMS content from {}: {}".format(gw.gwid, jid, fn, ioe))
         except email.errors.MessageParseError as mpe:
@@ -142,7 +205,7 @@ def inbound(content_fn, meta_xml=None):
             log.warning("[{}] {} internal error handling received MMS: {}".format(gw.gwid, jid, ex))
             log.debug("[{}] {} traceback: {}".format(gw.gwid, jid, traceback.format_exc()))
     else:
-        e = None
+        content = e = None
         meta = ET.fromstring(meta_xml)
         ns = meta.tag[meta.tag.find("{"):meta.tag.find("}")+1]
         tag = meta.tag.replace(ns, "")
@@ -152,7 +215,7 @@ def inbound(content_fn, meta_xml=None):
     if handler is None:
         log.info("[{}] {} unhandled message type".format(gw.gwid, jid))
     elif handler == "INBOUND_MMS":
-        res = gw.process_inbound_mms(jid, e, meta)
+        res = gw.process_inbound_mms(jid, content, meta)
     elif handler == "OUTBOUND_ACK":
         res = gw.process_ack_for_outbound(e, meta)
     elif handler == "OUTBOUND_DR":
@@ -174,15 +237,131 @@ def send_event_for_inbound_mms(rxid, ev, ref, ev_status, ev_desc, ev_target, app
         gw.send_rr_for_inbound(applies_to_num, ev_target, rxid, ref, ev_status, ev_desc)
 
 
-def reschedule(job, queue):
+class Submission(object):
+# a transmission to the peer: the recipients of a message, or a part of them, if there are
+# too many for a single transmission, or the recipients of several messages with the same 
+# template and options, merged together. it looks like a message to the gateway render 
+# functions; the events are recorded on each of the messages, for their own recipients
+
+    id = None
+    template = None
+    origin = ""
+    priority = ""
+    linked_id = ""
+    last_tran_id = None
+    destination = set()
+    cc = set()
+    bcc = set()
+    members = []             # ( message, recipients, all recipients of the message? )
+    jobs = []                # transmission jobs of the merged messages
+
+
+    def __init__(self, tx):
+        self.id = tx.id
+        self.template = tx.template
+        self.origin = tx.origin
+        self.priority = tx.priority
+        self.linked_id = tx.linked_id
+        self.last_tran_id = tx.last_tran_id
+        self.destination = set()
+        self.cc = set()
+        self.bcc = set()
+        self.members = []
+        self.jobs = []
+
+
+    def add(self, tx, rcpts, job=None):
+        # add recipients of a message, as ( address, "destination"|"cc"|"bcc" ) tuples
+        for a, kind in rcpts:
+            getattr(self, kind).add(a)
+        whole = len(rcpts) == len(tx.destination | tx.cc | tx.bcc)
+        self.members.append(( tx, [ a for a, _ in rcpts ], whole ))
+        if job:
+            self.jobs.append(job)
+
+
+    def recipients(self, tx=None):
+        if tx is None:
+            return list(self.destination | self.cc | self.bcc)
+        return [ a for m, rcpts, _ in self.members if m.id == tx.id for a in rcpts ]
+
+
+    def seal(self):
+        # a submission carrying exactly one message keeps the id of the message; any other 
+        # gets its own id, and the references needed to map the peer responses, delivery 
+        # reports and read replies back to the messages and their recipients
+        if len(self.members) == 1 and self.members[0][2]:
+            return self
+        self.id = str(uuid.uuid4()).replace("-", "")
+        self.last_tran_id = str(uuid.uuid4()).replace("-", "")
+        if len(self.members) > 1:
+            # the recipients of different messages should not see each other
+            self.bcc |= self.destination | self.cc
+            self.destination = set()
+            self.cc = set()
+        p = rdb.pipeline()
+        p.hmset('mmssub-' + self.id, { a: m.id for m, rcpts, _ in self.members for a in rcpts })
+        p.expireat('mmssub-' + self.id, int(time.time()) + MMS_TTL)
+        p.execute()
+        return self
+
+
+    def set_state(self, state, err="", desc="", gwid="", gw_url="", extra=None):
+        callbacks = []
+        p = rdb.pipeline()
+        for m, rcpts, whole in self.members:
+            m.set_state([] if whole else rcpts, state, err, desc, gwid, gw_url, extra, 
+                pipe=p, callbacks=callbacks
+            )
+        p.execute()
+        if callbacks:
+            rq.Queue("QEV", connection=rdbq).enqueue_many(callbacks)
+
+
+    def finish(self):
+        for j in self.jobs:
+            j.set_status(JobStatus.FINISHED)
+            j.cleanup(500)
+            THIS_GW.delayed.release(j.origin, j.id)
+
+
+    def reschedule(self, media_pending=False):
+        for j in self.jobs:
+            reschedule(j, media_pending=media_pending)
+
+
+def reschedule(job, queue=None, media_pending=False):
+    # put the job back in its queue (its priority lane, for transmissions), after a delay
+    # growing with every retry
+    queue = queue or rq.Queue(job.origin, connection=rdbq)
+    if media_pending:
+        # waiting for a media file being downloaded is not a failed attempt: the waits 
+        # have their own count, enough to outlast a couple of download leases
+        max_waits = int(2 * THIS_GW.media_fetch_timeout / max(1, THIS_GW.media_fetch_wait)) + 1
+        job.meta['media_waits'] = job.meta.get('media_waits', 0) + 1
+        if job.meta['media_waits'] > max_waits:
+            log.warning("[{}] {} transaction aborted, media not available"
+                .format(THIS_GW.gwid, job.get_id())
+            )
+            THIS_GW.delayed.release(job.origin, job.id)
+            return
+        job.save_meta()
+        THIS_GW.delayed.schedule(job, queue, THIS_GW.media_fetch_wait, job.ttl)
+        return
     job.meta['retries'] = job.meta['retries'] - 1
     if job.meta['retries'] < 0:
         log.warning("[{}] {} transaction aborted, too many retries"
             .format(THIS_GW.gwid, job.get_id())
         )
+        # a job taken along with another one waits in the delayed set until released
+        THIS_GW.delayed.release(job.origin, job.id)
     else:
         job.save_meta()
-        queue.enqueue_job(job)
+        delay = DelayedJobs.backoff(MAX_GW_RETRIES - job.meta['retries'] - 1, 
+            GW_RETRY_DELAY, GW_MAX_RETRY_DELAY
+        )
+        log.debug("[{}] {} rescheduled in {:.1f}s".format(THIS_GW.gwid, job.get_id(), delay))
+        THIS_GW.delayed.schedule(job, queue, delay, job.ttl)
 
 
 class MMSGateway(object):
@@ -190,6 +369,8 @@ class MMSGateway(object):
     gwid = None
     q_tx = None
     q_rx = None
+    lanes = []               # ( queue, weight ) for the transmission priority lanes
+    delayed = None           # rescheduled jobs, waiting for their retry time
 
     # gateway
     name = None
@@ -199,8 +380,19 @@ class MMSGateway(object):
     carrier = ""
     active = True
     tps_limit = 0
+    tps_burst = 0
+    tps = None               # token bucket shared by all the instances in the group
+    executors = 1            # jobs executed concurrently by this gateway instance
     tmp_dir = None
     events_url = ""
+    render_cache = None      # rendered MIME content of the templates, see render_content()
+    media_fetch_timeout = 60
+    media_fetch_wait = 5
+    media_connect_timeout = 5
+    release_lease = None
+    max_recipients = 100     # recipients in a single transmission to the peer
+    merge_messages = False   # merge messages with the same template in a single transmission
+    merge_lookahead = 100    # queued messages checked for merging
 
     # outbound
     secure = False
@@ -235,8 +427,11 @@ class MMSGateway(object):
     def __init__(self, gwid):
         self.gwid = gwid
         self.group = gwid.split(":")[0]
-        self.q_tx = rq.Queue("QTX-" + self.group, connection=rdbq)
+        self.q_tx = rq.Queue(tx_queue_name(self.group), connection=rdbq)
         self.q_rx = rq.Queue("QRX-" + self.group, connection=rdbq)
+        self.render_cache = LRUCache()
+        self.release_lease = rdbq.register_script(RELEASE_LEASE_SCRIPT)
+        models.template.invalidation_hooks.append(self._template_changed)
 
 
     def config(self, cfg):
@@ -245,11 +440,41 @@ class MMSGateway(object):
         self.protocol_version = cfg['gateway'].get('version')
         self.carrier = cfg['gateway'].get('carrier', "")
         self.tps_limit = int(cfg['gateway'].get('tps_limit', 0))
+        self.tps_burst = int(cfg['gateway'].get('tps_burst', self.tps_limit))
+        self.executors = int(cfg['gateway'].get('executors', 1))
+        # every priority has its lane, as messages are queued for all of them; those not
+        # listed in the weights get a weight of 1
+        weights = dict.fromkeys(ACCEPTED_MESSAGE_PRIORITIES, 1)
+        for lw in cfg['gateway'].get('priority_weights', "high:6,normal:3,low:1").split(","):
+            if not lw.strip():
+                continue
+            pri, _, w = [ x.strip() for x in lw.partition(":") ]
+            w = w or "1"
+            if pri not in weights or not w.isdigit() or int(w) < 1:
+                raise ValueError("invalid priority_weights entry '{}': expected <priority>:<weight>, "
+                    "with a priority in {} and a weight of at least 1".format(lw.strip(), ACCEPTED_MESSAGE_PRIORITIES))
+            weights[pri] = int(w)
+        self.lanes = [ 
+            ( rq.Queue(tx_queue_name(self.group, pri), connection=rdbq), w ) for pri, w in weights.items() 
+        ]
+        # rescheduled jobs wait in a delayed set of the queue they came from
+        self.delayed = DelayedJobs([ q.name for q, _ in self.lanes ] + [ "QRX-" + self.group, "QEV-" + self.group ])
+        if self.tps_limit > 0:
+            self.tps = TokenBucket(self.group, self.tps_limit, self.tps_burst)
         self.events_url = cfg['gateway'].get('events_url', "")
         self.tmp_dir = cfg['gateway'].get('tmp_dir', "/tmp/mms/")
 
         self.secure = cfg['outbound'].get('secure_connection', "").lower() in ("yes", "true", "t", "1")
         self.heartbeat = cfg['outbound'].get('heartbeat')
+        self.render_cache = LRUCache(
+            int(cfg['outbound'].get('render_cache_items', 100)),
+            int(cfg['outbound'].get('render_cache_size', 64 * 1024 * 1024))
+        )
+        self.media_fetch_timeout = int(cfg['outbound'].get('media_fetch_timeout', 60))
+        self.media_fetch_wait = float(cfg['outbound'].get('media_fetch_wait', 5))
+        self.media_connect_timeout = float(cfg['outbound'].get('media_connect_timeout', 5))
+        self.max_recipients = int(cfg['outbound'].get('max_recipients', 100))
+        self.merge_messages = cfg['outbound'].get('merge_messages', "false").lower() in ("yes", "true", "t", "1")
         if len(cfg['outbound'].get('username', "")) > 0 and len(cfg['outbound'].get('password', "")) > 0:
             self.auth = ( cfg['outbound']['username'], cfg['outbound']['password'] )
 
@@ -272,6 +497,254 @@ class MMSGateway(object):
         self.aux_applic_info = cfg['features'].get('aux_applic_info')
 
 
+    def _template_changed(self, key):
+        # drop the rendered content of a template that changed, or uses a part that changed
+        kind, _, oid = key.partition("-")
+        if kind == "mmstpl":
+            self.render_cache.invalidate(lambda k: k[0] == oid)
+        elif kind == "mmspart":
+            self.render_cache.invalidate(lambda k: oid in k[3].split(","))
+
+
+    def cache_stats(self):
+        # the render cache counters, logged with the heartbeat, and kept for as long as 
+        # the heartbeat for the status API (see get_gateway_status())
+        st = self.render_cache.stats()
+        try:
+            p = rdbq.pipeline()
+            p.hmset('gwcache-' + self.gwid, st)
+            p.expire('gwcache-' + self.gwid, GW_HEARTBEAT_TIMER * (2 + GW_HEARTBEATS))
+            p.execute()
+        except Exception as e:
+            log.warning("[{}] failed storing the render cache stats: {}".format(self.gwid, e))
+        return st
+
+
+    def _fetch_media(self, tpl, p, msgid=""):
+        # download the media file of a part, unless already exists; the file is named 
+        # after the url, so all the templates using the same media share the file. across 
+        # all the gateway instances, only the one holding the lease for the url downloads 
+        # it, while the others wait for a while for the file to show up, then give up
+        url_hash = hashlib.sha1(p.content_url.encode()).hexdigest()
+        fn = repo(self.tmp_dir, url_hash + ACCEPTED_CONTENT_TYPES.get(p.content_type, ""))
+        if os.path.exists(fn):
+            return fn
+        lease = 'mmsfetch-' + url_hash
+        if rdbq.set(lease, self.gwid, nx=True, ex=self.media_fetch_timeout):
+            try:
+                # another instance may have finished the download just before the lease
+                # was taken
+                if os.path.exists(fn):
+                    return fn
+                log.debug("[{}] {} downloading {}".format(self.gwid, msgid, p.content_url))
+                # the download ends before the lease does
+                return download_to_file(p.content_url, fn, 
+                    timeout=( self.media_connect_timeout, self.media_fetch_timeout ), 
+                    max_time=self.media_fetch_timeout
+                )
+            finally:
+                self.release_lease(keys=[ lease ], args=[ self.gwid ])
+        deadline = time.time() + self.media_fetch_wait
+        while time.time() < deadline:
+            time.sleep(0.1)
+            if os.path.exists(fn):
+                return fn
+            if not rdbq.exists(lease):
+                # the download finished, but nothing was saved
+                return None
+        raise MediaPending("{} being downloaded by {}".format(p.content_url, (rdbq.get(lease) or b"").decode()))
+
+
+    def _mime_parts(self, tpl, msgid=""):
+        # build the MIME objects for the parts of a template, returns a list of 
+        # ( part, mime_part, media ) tuples; the media files are not loaded in the MIME 
+        # object, only its headers are set, and media is the file content as it is sent
+        ret = []
+        for p in tpl.get_parts():
+            content = None
+            if p.content:
+                # actual content is provided in the part object itself
+                content = p.content
+            elif (
+                p.content_url.startswith("file://") or
+                p.content_url.startswith("http://") or 
+                p.content_url.startswith("https://")
+            ):
+                # download the media file, unless already exists
+                content = self._fetch_media(tpl, p, msgid)
+            if not content:
+                log.warning("[{}] {} failed to obtain content at {} for part '{}' in message {}"
+                    .format(self.gwid, msgid, p.content_url, p.content_name, tpl.id)
+                )
+                continue
+            log.debug("[{}] {} message {} part {} saved as '{}'"
+                .format(self.gwid, msgid, tpl.id, p.content_name, content)
+            )
+            mp = None
+            media = None
+            try:
+                if p.content_type == "application/smil":
+                    mp = MIMEBase("application", "smil", name=p.content_name + ".smil")
+                    mp.set_payload(content)
+                elif p.content_type == "text/plain":
+                    mp = MIMEText(content)
+                elif p.content_type.startswith("image/") or p.content_type.startswith("audio/"):
+                    # encoded once, in a file shared by all the gateway instances
+                    media, encoding = pre_encoded(content)
+                    mp = MIMEBase(*p.content_type.split("/", 1))
+                    mp['Content-Transfer-Encoding'] = encoding
+                    mp.set_payload("")
+            except Exception as exc:
+                log.warning("[{}] {} failed to create MIME part '{}' component for message {}: {}"
+                    .format(self.gwid, msgid, p.content_name, tpl.id, exc)
+                )
+                mp = None
+            if mp:
+                mp.add_header("Content-Id", p.content_name)
+                ret.append(( p, mp, media ))
+        return ret
+
+
+    def render_content(self, tpl, subtype, boundary, msgid=""):
+        # the MIME body holding the template parts, in wire form, and the 
+        # ( content_name, content_type ) of the parts included; the body is the same for 
+        # all the messages built from a template, only the headers (and the MM7 envelope)
+        # differ, so the body is rendered once and cached. the media files are not part of
+        # the cached body, they are encoded from the files while being sent
+        key = ( tpl.id, self.group, subtype, ",".join(tpl.parts) )
+        c = self.render_cache.get(key)
+        if c is not None and c[0].valid():
+            return c
+        body = WireBody()
+        parts = []
+        for p, mp, media in self._mime_parts(tpl, msgid):
+            body.write("--" + boundary + "\r\n")
+            body.write(wire(mp.as_string()))
+            if media is not None:
+                body.write(media)
+            body.write(CRLF)
+            parts.append(( p.content_name, p.content_type ))
+        body.close(boundary)
+        c = ( body, parts )
+        self.render_cache.put(key, c, body.resident())
+        log.debug("[{}] {} rendered content of template {}, {} bytes in {} parts, {} in memory"
+            .format(self.gwid, msgid, tpl.id, len(body), len(parts), body.resident())
+        )
+        return c
+
+
+    def _add_parts(self, rx, content):
+        # store the parts of a received message in its template, reading them from the 
+        # content file one at a time
+        ret_code, ret_desc = '200', ""
+        n = 0
+        try:
+            if content is not None and content.multipart():
+                log.debug("[{}] {} Handling content as multipart".format(self.gwid, rx.id))
+            for mp, read in (content.parts() if content is not None else []):
+                n += 1
+                if mp.get_content_maintype() == "multipart":
+                    ret_code = '400'
+                    ret_desc = "Unexpected multipart where media content was expected"
+                else:
+                    ret_code, ret_desc = rx.template.add_part_from_mime(mp, read, self.media_repo, self.media_url_prefix)
+                if ret_code == '200':
+                    p = models.template.MMSMessagePart(rx.template.parts[-1])
+                    log.info("[{}] {} Processed {} part '{}' stored as {}".format(
+                        self.gwid, rx.id, p.content_type, p.content_name, 
+                        p.content_url or "object property"
+                    ))
+                else:
+                    log.info("[{}] {} Not processed message part: {} {}".format(
+                        self.gwid, rx.id, ret_code, ret_desc
+                    ))
+            log.debug("[{}] {} {} content parts handled".format(self.gwid, rx.id, n))
+            rx.template.save()
+        except (email.errors.MessageError, ValueError) as ee:
+            log.info("[{}] {} Message content processing error: {}".format(self.gwid, rx.id, ee))
+            ret_code = '400'
+            ret_desc = "Error processing message MIME parts"
+        except Exception as ex:
+            log.info("[{}] {} Message content processing failure: {}".format(self.gwid, rx.id, ex))
+            log.debug(traceback.format_exc())
+            ret_code = '500'
+            ret_desc = "Error processing message MIME parts"
+        return ret_code, ret_desc
+
+
+    def throttle(self, msgid=""):
+        # wait for our turn to transmit, so that the whole group stays within the tps limit
+        if self.tps is None:
+            return
+        w = self.tps.wait()
+        if w > 0:
+            log.debug("[{}] {} throttled for {:.3f}s".format(self.gwid, msgid, w))
+
+
+    def plan(self, tx, job=None):
+        # the submissions needed to transmit a message: its recipients (except those 
+        # already done in a previous attempt) in chunks of up to max_recipients; a message 
+        # fitting in one submission may carry other messages waiting in the queue, too
+        done = set(job.meta.get('done', [])) if job else set()
+        rcpts = [ 
+            ( a, kind ) for kind in ( "destination", "cc", "bcc" ) 
+            for a in sorted(getattr(tx, kind)) if a not in done 
+        ]
+        limit = self.max_recipients or len(rcpts) or 1
+        subs = []
+        for i in range(0, len(rcpts), limit):
+            sub = Submission(tx)
+            sub.add(tx, rcpts[i:i + limit])
+            subs.append(sub)
+        if len(subs) == 1 and job and self.merge_messages and not done and not (tx.cc or tx.bcc):
+            self._merge(subs[0], tx, job)
+        if len(subs) > 1:
+            log.info("[{}] {} {} recipients planned in {} submissions".format(self.gwid, tx.id, len(rcpts), len(subs)))
+        return [ sub.seal() for sub in subs ]
+
+
+    def _merge(self, sub, tx, job):
+        # take over the messages with the same template and options, waiting at the head 
+        # of the queue the job came from, as long as there is room for their recipients;
+        # a message is only taken if it can be taken out of the queue, so no other 
+        # executor sends it too
+        room = self.max_recipients - len(sub.recipients())
+        if room <= 0:
+            return
+        q_key = rq.Queue(job.origin, connection=rdbq).key
+        lease = (job.timeout if job.timeout and job.timeout > 0 else 180) + 60
+        ids = [ i.decode() for i in rdbq.lrange(q_key, 0, self.merge_lookahead - 1) ]
+        if not ids:
+            return
+        p = rdb.pipeline()
+        for i in ids:
+            p.hmget('mms-' + i, 'template_id', 'origin', 'priority', 'linked_id', 'destination', 'cc', 'bcc')
+        for i, md in zip(ids, p.execute()):
+            if md[0] != tx.template.id or md[1:4] != [ tx.origin, tx.priority, tx.linked_id ] \
+                or not md[4] or md[5] or md[6] or len(md[4].split(",")) > room:
+                continue
+            try:
+                j = Job.fetch(i, connection=rdbq)
+            except NoSuchJobError:
+                continue
+            # the job is moved from the queue to the delayed set of the queue, due when the
+            # transmission should be long done; it is removed from there when done or
+            # rescheduled, and comes back in the queue if this instance dies meanwhile
+            if j.func_name != 'models.gateway.send_mms' or not self.delayed.take(job.origin, i, lease):
+                continue
+            j.set_status(JobStatus.STARTED)
+            m = models.message.MMSMessage(i)
+            m.gateway_id += self.gwid + " "
+            m.processed_ts = int(time.time())
+            m.save()
+            sub.add(m, [ ( a, "destination" ) for a in sorted(m.destination) ], j)
+            room -= len(m.destination)
+            if room <= 0:
+                break
+        if len(sub.members) > 1:
+            log.info("[{}] {} merged with {} messages".format(self.gwid, tx.id, len(sub.members) - 1))
+
+
 class MM4Gateway(MMSGateway):
 
     MEDIA_ERROR_MAP = {
@@ -297,7 +770,11 @@ class MM4Gateway(MMSGateway):
         '406': "Deleted without being read",
     }
 
-    connection = None
+    connection = None        # heartbeat connection
+    pool = None              # SMTP sessions for transmissions
+    pool_size = 4
+    pool_max_idle = 30
+    pool_wait = GW_HEARTBEAT_TIMER
     remote_domain = None
     local_domain = None
     originator_addr = None
@@ -331,39 +808,44 @@ class MM4Gateway(MMSGateway):
         self.return_route = cfg['features'].get('return_route')
         self.mmsip_addr = cfg['features'].get('mmsip_address')
         self.forward_route = cfg['features'].get('forward_route')
+        self.pool_size = int(cfg['outbound'].get('connections', 4))
+        self.pool_max_idle = int(cfg['outbound'].get('connection_max_idle', 30))
 
 
     def connect(self):
-        # try connecting to the remote MMSC we will use for sending MTs
+        # try connecting to the remote MMSC we will use for sending MTs; returns None if 
+        # the connection fails
         log.debug("[{}] connecting to {}:{} as {}"
             .format(self.gwid, self.remote_peer[0], self.remote_peer[1], self.this_host)
         )
         try:
             if self.secure:
-                self.connection = smtplib.SMTP_SSL(
+                return smtplib.SMTP_SSL(
                     self.remote_peer[0], self.remote_peer[1], 
                     self.this_host, 
                     self.ssl_certificate[0], self.ssl_certificate[1],
                     GW_HEARTBEAT_TIMER
                 )
             else:
-                self.connection = smtplib.SMTP(
+                return smtplib.SMTP(
                     self.remote_peer[0], self.remote_peer[1], 
                     self.this_host, 
                     GW_HEARTBEAT_TIMER
                 )
-            # self.connection will be None if this fails
         except smtplib.SMTPException as se:
             log.critical("[{}] Gateway connection error: {}".format(self.gwid, se))
         except Exception as e:
             log.critical("[{}] Gateway connection error: {}".format(self.gwid, e))
+        return None
 
 
     def start(self):
-        # start outbound gateway
+        # start outbound gateway; the heartbeat uses its own connection, the transmissions 
+        # use the sessions in the pool
         if self.heartbeat:
             rdbq.set('gwstat-' + self.gwid, 1, 3 + GW_HEARTBEAT_TIMER)
-        self.connect()
+        self.pool = SMTPPool(self.gwid, self.connect, max(self.pool_size, self.executors), self.pool_max_idle)
+        self.connection = self.connect()
         return self.connection is not None
 
 
@@ -374,7 +856,7 @@ class MM4Gateway(MMSGateway):
             return False
         if self.connection is None:
             # try reconnecting
-            self.connect()
+            self.connection = self.connect()
             if self.connection is None:
                 # connection still didnt work, set gateway in an uncertain functional state
                 log.critical("[{}] Currently no connection to remote MMSC".format(self.gwid))
@@ -385,14 +867,15 @@ class MM4Gateway(MMSGateway):
                 rdbq.set('gwstat-' + self.gwid, GW_HEARTBEATS, 
                     ex=(GW_HEARTBEAT_TIMER * (2 + GW_HEARTBEATS))
                 )
-                log.debug("[{}] _/\_".format(self.gwid))
+                log.debug("[{}] _/\\_ {} render cache {}".format(self.gwid, self.pool.stats(), self.cache_stats()))
             else:
                 log.critical("[{}] Remote server didn't like our {}: {}".format(self.gwid, meth, rp))
             return str(rp[0]) in (expect, '250')
-        except smtplib.SMTPException as se:
+        except smtplib.SMTPServerDisconnected as sd:
+            log.critical("[{}] Gateway heartbeat failed: {}".format(self.gwid, sd))
+            self.connection = None
+        except (smtplib.SMTPException, OSError) as se:
             log.critical("[{}] Gateway heartbeat failed: {}".format(self.gwid, se))
-            if se.message.startswith("Connection unexpectedly closed"):
-                self.connection = None
         except AttributeError:
             pass
         return True
@@ -410,55 +893,15 @@ class MM4Gateway(MMSGateway):
             e['To'] = ",".join([self.dest_prefix + a + self.dest_suffix for a in tx.destination])
         if len(tx.cc):
             e['Cc'] = ",".join([self.dest_prefix + a + self.dest_suffix for a in tx.cc])
-        if len(tx.bcc):
-            e['Bcc'] = ",".join([self.dest_prefix + a + self.dest_suffix for a in tx.bcc])
+        # bcc recipients are only given in the envelope (RCPT TO), never in the headers
+        if not len(tx.destination) and not len(tx.cc):
+            e['To'] = "undisclosed-recipients:;"
         
-        for pid in tx.template.parts:
-            p = models.template.MMSMessagePart(pid)
-            if p.content:
-                # actual content is provided in the part object itself
-                content = p.content
-            elif (
-                p.content_url.startswith("file://") or
-                p.content_url.startswith("http://") or 
-                p.content_url.startswith("https://")
-            ):
-                # download the media file, unless already exists
-                content = repo(self.tmp_dir, tx.template.id + "-" + p.content_name)
-                if not os.path.exists(content):
-                    content = download_to_file(p.content_url, content)
-            if not content:
-                log.warning("[{}] {} failed to obtain content at {} for part '{}' in message {}"
-                    .format(self.gwid, tx.id, p.content_url, p.content_name, tx.template.id)
-                )
-                continue
-            log.debug("[{}] {} message {} part {} saved as '{}'"
-                .format(self.gwid, tx.id, tx.template.id, p.content_name, content)
-            )
-            mp = None
-            try:
-                if p.content_type == "application/smil":
-                    mp = MIMEBase("application", "smil", name=p.content_name + ".smil")
-                    mp.set_payload(content)
-                    e.set_param("start", p.content_name)
-                elif p.content_type == "text/plain":
-                    mp = MIMEText(content)
-                elif p.content_type.startswith("image/"):
-                    fh = open(content, "rb")
-                    mp = MIMEImage(fh.read())
-                    fh.close()
-                elif p.content_type.startswith("audio/"):
-                    fh = open(content, "rb")
-                    mp = MIMEAudio(fh.read())
-                    fh.close()
-            except Exception as exc:
-                log.warning("[{}] {} failed to create MIME part '{}' component for message {}: {}"
-                    .format(self.gwid, tx.id, p.content_name, tx.template.id, exc)
-                )
-                mp = None
-            if mp:
-                mp.add_header("Content-Id", p.content_name)
-                e.attach(mp)
+        body, parts = self.render_content(tx.template, "related", TOP_PART_BOUNDARY, tx.id)
+        e.set_payload("")
+        for name, content_type in parts:
+            if content_type == "application/smil":
+                e.set_param("start", name)
 
         e.add_header("User-Agent", USER_AGENT)
         e.add_header("X-Mms-3GPP-MMS-Version", self.protocol_version)
@@ -503,20 +946,45 @@ class MM4Gateway(MMSGateway):
         if self.return_route:
             e.add_header("X-Mms-Return-Route", self.return_route)
 
-        return e
+        # the message headers, followed by the cached content, in wire form
+        wb = WireBody()
+        wb.write(wire(e.as_string()))
+        wb.extend(body)
+        return wb
 
 
     def send_to_mmsc(self, payload, msgid, rcpt_from, mail_to):
-        pl = payload.as_string()
+        # the payload is either an email message, or a message already in wire form, that
+        # is sent in blocks as it is produced
+        streamed = isinstance(payload, WireBody)
+        pl = payload if streamed else payload.as_string()
+        head = payload.head(4096) if streamed else pl[:4096]
         log.debug("[{}] sending {} as MM4: {}{}"
-            .format(self.gwid, msgid, pl[:4096], ("..." if len(pl) > 4096 else ""))
+            .format(self.gwid, msgid, head, ("..." if len(pl) > 4096 else ""))
         )
         if len(pl) > 4096:
-            log.debug("[{}] {} ...{}".format(self.gwid, msgid, pl[-256:]))
-        smtp_err = ""
+            log.debug("[{}] {} ...{}".format(self.gwid, msgid, payload.tail(256) if streamed else pl[-256:]))
+        if not streamed:
+            # sent the same way, so that a session lost after DATA can be told apart
+            body = WireBody()
+            body.write(wire(pl))
+            pl = body
         try:
-            self.connection.sendmail(rcpt_from, mail_to, pl)
-            return None, ""
+            for attempt in ( 1, 2 ):
+                try:
+                    with self.pool.session(self.pool_wait) as conn:
+                        smtp_send(conn, rcpt_from, mail_to, pl)
+                    return None, ""
+                except DataInterrupted:
+                    # the server may have taken the message already; no second try here, 
+                    # the transmission is rescheduled like for any other failure
+                    raise
+                except smtplib.SMTPServerDisconnected as sd:
+                    # the session was closed by the server while idle, before the message 
+                    # was sent, so try again on a new one
+                    if attempt == 2:
+                        raise
+                    log.info("[{}] {} SMTP session lost, reconnecting: {}".format(self.gwid, msgid, sd))
         except smtplib.SMTPRecipientsRefused as refused:
             log.info("[{}] {} all recipients in list {} were refused: {}"
                 .format(self.gwid, msgid, mail_to, refused)
@@ -525,7 +993,7 @@ class MM4Gateway(MMSGateway):
         except smtplib.SMTPSenderRefused:
             log.info("[{}] {} sender {} refused".format(self.gwid, msgid, rcpt_from))
             return "41", "SMTP error (sender address refused)"
-        except smtplib.SMTPException as smtpe:
+        except (smtplib.SMTPException, OSError) as smtpe:
             log.info("[{}] {} email not sent: {}".format(self.gwid, msgid, smtpe))
             return "40", "SMTP error (see gateway logs)"
 
@@ -540,7 +1008,8 @@ class MM4Gateway(MMSGateway):
             list([self._phone_num_from_address(e) for e in cdl.split(",")])
 
 
-    def process_inbound_mms(self, mid, m, _):
+    def process_inbound_mms(self, mid, content, _):
+        m = content.headers
         if "X-Mms-Message-Id" in m:
             rx = models.message.MMSMessage()
             rx.id = mid
@@ -612,40 +1081,7 @@ class MM4Gateway(MMSGateway):
         )
 
         # parse content parts
-        try:
-            if m.is_multipart():
-                mime_parts = m.get_payload()
-                log.debug("[{}] {} Handling content as multipart, {} parts"
-                    .format(self.gwid, rx.id, len(mime_parts))
-                )
-            else:
-                mime_parts = [ m ]
-            for mp in mime_parts:
-                if mp.is_multipart():
-                    ret_code = '400'
-                    ret_desc = "Unexpected multipart where media content was expected"
-                else:
-                    ret_code, ret_desc = rx.template.add_part_from_mime(mp, self.media_repo, self.media_url_prefix)
-                if ret_code == '200':
-                    p = models.template.MMSMessagePart(rx.template.parts[-1])
-                    log.info("[{}] {} Processed {} part '{}' stored as {}".format(
-                        self.gwid, rx.id, p.content_type, p.content_name, 
-                        p.content_url or "object property"
-                    ))
-                else:
-                    log.info("[{}] {} Not processed message part: {} {}".format(
-                        self.gwid, rx.id, ret_code, ret_desc
-                    ))
-            rx.template.save()
-        except email.errors.MessageError as ee:
-            log.info("[{}] {} Message content processing error: {}".format(self.gwid, rx.id, ee))
-            ret_code = '400'
-            ret_desc = "Error processing message MIME parts"
-        except Exception as ex:
-            log.info("[{}] {} Message content processing failure: {}".format(self.gwid, rx.id, ex))
-            log.debug(traceback.format_exc())
-            ret_code = '500'
-            ret_desc = "Error processing message MIME parts"
+        ret_code, ret_desc = self._add_parts(rx, content)
 
         if 'X-Mms-Ack-Request' in m and m['X-Mms-Ack-Request'].lower() == "yes":
             # sender requested to send them an ack
@@ -791,27 +1227,30 @@ class MM4Gateway(MMSGateway):
     def process_ack_for_outbound(self, em, __):
         txid = em.get('X-Mms-Message-Id', "").replace("\"", "")
         log.debug("[{}] {} MT ack: {}".format(self.gwid, txid, em.as_string()))
-        tx = models.message.MMSMessage(txid)
-        if tx is None:
+        destinations = self._parse_address_list(em['X-Mms-Request-Recipients'])
+        msgs = models.message.MMSMessage.lookup(txid, destinations)
+        if not msgs:
             log.warning("[{}] transaction {} not found".format(self.gwid, txid))
             return None
-        destinations = self._parse_address_list(em['X-Mms-Request-Recipients']) or [ "*" ]
         log.info("[{}] {} ACK response for {}: {} {}"
-            .format(self.gwid, txid, destinations, em['X-Mms-Request-Status-Code'], em['X-Mms-Status-Text'])
+            .format(self.gwid, txid, destinations or [ "*" ], em['X-Mms-Request-Status-Code'], em['X-Mms-Status-Text'])
         )
         status = "ACKNOWLEDGED" if em['X-Mms-Request-Status-Code'].lower() == "ok" else "FAILED"
         code = list(self.MEDIA_ERROR_MAP.keys())[list(self.MEDIA_ERROR_MAP.values()).index(em['X-Mms-Request-Status-Code'])]
-        tx.set_state(
-            destinations, status, code, em['X-Mms-Request-Status-Code'] + " " + em['X-Mms-Status-Text'], 
-            self.gwid, self.events_url
-        )
+        for msgid, rcpts in msgs.items():
+            models.message.MMSMessage(msgid).set_state(
+                rcpts, status, code, em['X-Mms-Request-Status-Code'] + " " + em['X-Mms-Status-Text'], 
+                self.gwid, self.events_url
+            )
 
 
     def process_dr_for_outbound(self, em, __):
         txid = em.get('X-Mms-Message-Id', "").replace("\"", "")
-        if txid:
-            tx = models.message.MMSMessage(txid) 
-        if txid is None or tx.id is None:
+        # the reference may be a submission carrying several messages, find the one 
+        # sent to the recipient reporting
+        msgs = models.message.MMSMessage.lookup(txid, [ self._phone_num_from_address(em['To']) ]) if txid else {}
+        tx = models.message.MMSMessage(next(iter(msgs))) if msgs else None
+        if tx is None or tx.id is None:
             log.warning("[{}] original message with id '{}' not found".format(self.gwid, txid))
             return None
         log.debug("[{}] {} processing MT DLR".format(self.gwid, tx.id))
@@ -896,6 +1335,9 @@ class MM7Gateway(MMSGateway):
     vasid = None
     service_code = None
     peer_timeout = 10
+    http = None              # keep-alive connections to the MMSC
+    pool_size = 10
+    concurrency = 1          # transmissions in flight at the same time
 
     def __init__(self, gwid):
         super(MM7Gateway, self).__init__(gwid)
@@ -908,12 +1350,20 @@ class MM7Gateway(MMSGateway):
         self.vaspid = cfg['gateway'].get('vaspid', "")
         self.vasid = cfg['gateway'].get('vasid', "")
         self.service_code = cfg['gateway'].get('service_code', "")
-        self.peer_timeout = cfg['outbound'].get('timeout', 10.)
+        self.peer_timeout = float(cfg['outbound'].get('timeout', 10.))
+        self.pool_size = int(cfg['outbound'].get('connections', 10))
+        self.concurrency = int(cfg['outbound'].get('concurrency', 1))
+        if self.concurrency > 1 and self.executors > 1:
+            # the executors run the transmissions then, as many at a time as there are
+            raise ValueError("concurrency={} conflicts with executors={}: with several executors, "
+                "as many transmissions as executors are in flight; set one of them to 1"
+                .format(self.concurrency, self.executors))
 
 
     def start(self):
         # start outbound gateway
         self.connection = self.remote_peer
+        self.http = HTTPPool(self.gwid, max(self.pool_size, self.concurrency, self.executors))
         if self.heartbeat:
             rdbq.set('gwstat-' + self.gwid, 1, 3 + GW_HEARTBEAT_TIMER)
         return True
@@ -926,7 +1376,7 @@ class MM7Gateway(MMSGateway):
             return False
         try:
             meth, _, expect = self.heartbeat.partition(" ")
-            rp = requests.request(meth or "HEAD", self.connection, 
+            rp = self.http.request(meth or "HEAD", self.connection, 
                 headers={ 'Content-Length': "0", 'User-Agent': USER_AGENT }, 
                 auth=self.auth, timeout=GW_HEARTBEAT_TIMER
             )
@@ -934,7 +1384,7 @@ class MM7Gateway(MMSGateway):
                 rdbq.set('gwstat-' + self.gwid, GW_HEARTBEATS,
                     ex=(GW_HEARTBEAT_TIMER * (2 + GW_HEARTBEATS))
                 )
-                log.debug("[{}] _/\_".format(self.gwid))
+                log.debug("[{}] _/\\_ {} render cache {}".format(self.gwid, self.http.stats(), self.cache_stats()))
             else:
                 log.critical("[{}] Remote server didn't responded to our {} request: {}"
                     .format(self.gwid, meth, rp)
@@ -1032,70 +1482,24 @@ class MM7Gateway(MMSGateway):
         env_str = '<?xml version="1.0"?>' + ET.tostring(env).decode()
         log.debug("envelope: {}".format(env_str))
 
-        top_part = MIMEMultipart('related', boundary=TOP_PART_BOUNDARY)
-
-        env_part = email.message.Message()
-        env_part.set_type("text/xml")
-        env_part.add_header("Content-ID", tx.id + ".envelope")
-        env_part.set_payload(env_str)
-        top_part.attach(env_part)
-
-        content_part = MIMEMultipart()   # defaults to 'mixed'
-        content_part.add_header("Content-ID", tx.id + ".content")
-        first_part_id = ""
-
-        for pid in tx.template.parts:
-            p = models.template.MMSMessagePart(pid)
-            if p.content:
-                # actual content is provided in the part object itself
-                content = p.content
-            elif (
-                p.content_url.startswith("file://") or
-                p.content_url.startswith("http://") or
-                p.content_url.startswith("https://")
-            ):
-                # download the media file, unless already exists
-                content = repo(self.tmp_dir, tx.template.id + "-" + p.content_name)
-                if not os.path.exists(content):
-                    content = download_to_file(p.content_url, content)
-            if not content:
-                log.warning("[{}] {} failed to obtain content for part '{}' in message {}"
-                    .format(self.gwid, tx.id, p.content_name, tx.template.id)
-                )
-                continue
-            log.debug("[{}] {} message {} part {} saved as '{}'"
-                .format(self.gwid, tx.id, tx.template.id, p.content_name, content)
-            )
-            mp = None
-            try:
-                if p.content_type == "application/smil":
-                    mp = MIMEBase("application", "smil", name=p.content_name + ".smil")
-                    mp.set_payload(content)
-                elif p.content_type == "text/plain":
-                    mp = MIMEText(content)
-                elif p.content_type.startswith("image/"):
-                    fh = open(content, "rb")
-                    mp = MIMEImage(fh.read())
-                    fh.close()
-                elif p.content_type.startswith("audio/"):
-                    fh = open(content, "rb")
-                    mp = MIMEAudio(fh.read())
-                    fh.close()
-            except Exception as exc:
-                log.warning("[{}] {} failed to create MIME part '{}' component for message {}: {}"
-                    .format(self.gwid, tx.id, p.content_name, tx.template.id, exc)
-                )
-                mp = None
-            if mp:
-                mp.add_header("Content-Id", p.content_name)
-                content_part.attach(mp)
-                if len(first_part_id) == 0:
-                    content_part.set_param("start", p.content_name)
-                    first_part_id = p.content_name
-
-        top_part.attach(content_part)
-
-        return top_part
+        # the body is written in its wire form, as the SOAP envelope followed by the 
+        # content; the content is the cached template body, not copied
+        body, parts = self.render_content(tx.template, "mixed", CONTENT_PART_BOUNDARY, tx.id)
+        content_type = "multipart/mixed; boundary=\"" + CONTENT_PART_BOUNDARY + "\""
+        if parts:
+            content_type += "; start=\"" + parts[0][0] + "\""
+        wb = WireBody()
+        wb.part(TOP_PART_BOUNDARY, [ 
+            ( "Content-Type", "text/xml" ), 
+            ( "Content-ID", tx.id + ".envelope" ),
+        ], env_str)
+        wb.part(TOP_PART_BOUNDARY, [
+            ( "Content-Type", content_type ),
+            ( "Content-ID", tx.id + ".content" ),
+        ], body)
+        wb.close(TOP_PART_BOUNDARY)
+
+        return wb
 
 
     def send_to_mmsc(self, payload, msgid, from_addr=None, to_addrs=None):
@@ -1107,26 +1511,19 @@ class MM7Gateway(MMSGateway):
                 "boundary=\"" + TOP_PART_BOUNDARY + "\"; " +
                 "start=\"" + msgid + ".envelope\""
         }
-        content_lines = payload.as_string().splitlines()
-        content = ""; content_started = False
-        for l in content_lines:
-            # seek to the first occurence of the top part boundary
-            content_started = content_started or (l == "--" + TOP_PART_BOUNDARY)
-            if content_started and not l.startswith("MIME-Version:"):
-                content += l + "\r\n"
         log.debug("[{}] {} sending MM7 with headers: {}"
             .format(self.gwid, msgid, headers)
         )
         log.debug("[{}] {} content: {}{}"
-            .format(self.gwid, msgid, content[:4096], ("..." if len(content) > 4096 else ""))
+            .format(self.gwid, msgid, payload.head(4096), ("..." if len(payload) > 4096 else ""))
         )
-        if len(content) > 4096:
-            log.debug("[{}] {} ... {}".format(self.gwid, msgid, content[-256:]))
+        if len(payload) > 4096:
+            log.debug("[{}] {} ... {}".format(self.gwid, msgid, payload.tail(256)))
         try:
-            rp = requests.post(self.remote_peer,
+            rp = self.http.post(self.remote_peer,
                 auth=self.auth,
                 headers=headers,
-                data=content,
+                data=payload,
                 timeout=self.peer_timeout
             )
             log.info("[{}] {} response status {}: {}"
@@ -1196,7 +1593,7 @@ class MM7Gateway(MMSGateway):
     def process_inbound_mms(self, mid, content, meta):
     # processing an inbound message (MO)
     #     mid = message ID, assigned by our MM7 API
-    #     content = multipart content containing smil, media, etc
+    #     content = the content part (smil, media, etc), as a MIMEFile, or None
     #     meta = <body> part of the SOAP envelope, as an XML ElementTree object
 
         rx = models.message.MMSMessage(mid)
@@ -1246,40 +1643,7 @@ class MM7Gateway(MMSGateway):
         rx.template.save()
         rx.save()
 
-        try:
-            if content.is_multipart():
-                mime_parts = content.get_payload()
-                log.debug("[{}] {} Handling content as multipart, {} parts"
-                    .format(self.gwid, rx.id, len(mime_parts))
-                )
-            else:
-                mime_parts = [ content ]
-            for mp in mime_parts:
-                if mp.is_multipart():
-                    ret_code = '400'
-                    ret_desc = "Unexpected multipart in content"
-                else:
-                    ret_code, ret_desc = rx.template.add_part_from_mime(mp, self.media_repo, self.media_url_prefix)
-                if ret_code == '200':
-                    p = models.template.MMSMessagePart(rx.template.parts[-1])
-                    log.info("[{}] {} Processed {} part '{}' stored as {}".format(
-                        self.gwid, rx.id, p.content_type, p.content_name,
-                        p.content_url or "object property"
-                    ))
-                else:
-                    log.info("[{}] {} Not processed message part: {} {}".format(
-                        self.gwid, rx.id, ret_code, ret_desc
-                    ))
-            rx.template.save()
-        except email.errors.MessageError as ee:
-            log.info("[{}] {} Message content processing error: {}".format(self.gwid, rx.id, ee))
-            ret_code = '400'
-            ret_desc = "Error processing message MIME parts"
-        except Exception as ex:
-            log.info("[{}] {} Message content processing failure: {}".format(self.gwid, rx.id, ex))
-            log.debug(traceback.format_exc())
-            ret_code = '500'
-            ret_desc = "Error processing message MIME parts"
+        ret_code, ret_desc = self._add_parts(rx, content)
 
         rx.template.save()
         rx.save()
@@ -1300,12 +1664,17 @@ class MM7Gateway(MMSGateway):
 
     def process_dr_for_outbound(self, _, meta):
         ns = meta.tag[meta.tag.find("{"):meta.tag.find("}")+1]
-        tx = models.message.MMSMessage(rdb.get('mmsxref-' + meta.findtext("./" + ns + "MessageID", "").strip()))
+        ref = rdb.get('mmsxref-' + meta.findtext("./" + ns + "MessageID", "").strip())
 
         apply_to = \
             set(self._parse_address_list(meta.find("./" + ns + "Recipients/" + ns + "To"))) | \
             set(self._parse_address_list(meta.find("./" + ns + "Recipients/" + ns + "Cc"))) | \
             set(self._parse_address_list(meta.find("./" + ns + "Recipients/" + ns + "Bcc")))
+        # the reference may be a submission carrying several messages
+        msgs = models.message.MMSMessage.lookup(ref, list(apply_to)) if ref else {}
+        if not msgs:
+            log.warning("[{}] original message with reference '{}' not found".format(self.gwid, ref))
+            return None
 
         mt_status = meta.findtext("./" + ns + "MMStatus", "").strip().lower()
         (status, code) = \
@@ -1316,25 +1685,31 @@ class MM7Gateway(MMSGateway):
             ("UNDEFINED", '400')
         status_text = mt_status + ": " + meta.findtext("./" + ns + "StatusText", "")
         apx = meta.findtext("./" + ns + "ApplicID", "").strip()
-        tx.set_state(list(apply_to), status, code, status_text, self.gwid, self.events_url, 
-            extra={
-                'app': meta.findtext("./" + ns + "ApplicID", "").strip(),
-                'reply_app': meta.findtext("./" + ns + "ReplyApplicID", "").strip(),
-                'app_data': meta.findtext("./" + ns + "AuxApplicInfo", "").strip(),
-            }
-        )
+        for msgid, rcpts in msgs.items():
+            models.message.MMSMessage(msgid).set_state(rcpts, status, code, status_text, self.gwid, self.events_url, 
+                extra={
+                    'app': meta.findtext("./" + ns + "ApplicID", "").strip(),
+                    'reply_app': meta.findtext("./" + ns + "ReplyApplicID", "").strip(),
+                    'app_data': meta.findtext("./" + ns + "AuxApplicInfo", "").strip(),
+                }
+            )
 
-        log.info("[{}] {} Delivery report on MT processed successfully".format(self.gwid, tx.id))
+        log.info("[{}] {} Delivery report on MT processed successfully".format(self.gwid, ref))
 
 
     def process_rr_for_outbound(self, _, meta):
         ns = meta.tag[meta.tag.find("{"):meta.tag.find("}")+1]
-        tx = models.message.MMSMessage(rdb.get('mmsxref-' + meta.findtext("./" + ns + "MessageID", "").strip()))
+        ref = rdb.get('mmsxref-' + meta.findtext("./" + ns + "MessageID", "").strip())
 
         apply_to = \
             set(self._parse_address_list(meta.find("./" + ns + "Recipients/" + ns + "To"))) | \
             set(self._parse_address_list(meta.find("./" + ns + "Recipients/" + ns + "Cc"))) | \
             set(self._parse_address_list(meta.find("./" + ns + "Recipients/" + ns + "Bcc")))
+        # the reference may be a submission carrying several messages
+        msgs = models.message.MMSMessage.lookup(ref, list(apply_to)) if ref else {}
+        if not msgs:
+            log.warning("[{}] original message with reference '{}' not found".format(self.gwid, ref))
+            return None
 
         mt_status = meta.findtext("./" + ns + "MMStatus", "").strip().lower()
         (status, code) = \
@@ -1343,15 +1718,16 @@ class MM7Gateway(MMSGateway):
             ("UNDEFINED", 400)
         code = list(self.DR_STATUS_MAP.keys())[list(self.DR_STATUS_MAP.values()).index(em['X-Mms-MM-Status-Code'])]
         status_text = mt_status + ": " + meta.findtext("./" + ns + "StatusText", "")
-        tx.set_state(list(apply_to), status, code, status_text, self.gwid, self.events_url,
-            extra={
-                'app': meta.findtext("./" + ns + "ApplicID", "").strip(),
-                'reply_app': meta.findtext("./" + ns + "ReplyApplicID", "").strip(),
-                'app_data': meta.findtext("./" + ns + "AuxApplicInfo", "").strip(),
-            }
-        )
+        for msgid, rcpts in msgs.items():
+            models.message.MMSMessage(msgid).set_state(rcpts, status, code, status_text, self.gwid, self.events_url,
+                extra={
+                    'app': meta.findtext("./" + ns + "ApplicID", "").strip(),
+                    'reply_app': meta.findtext("./" + ns + "ReplyApplicID", "").strip(),
+                    'app_data': meta.findtext("./" + ns + "AuxApplicInfo", "").strip(),
+                }
+            )
 
-        log.info("[{}] {} Read-reply on MT processed successfully".format(self.gwid, tx.id))
+        log.info("[{}] {} Read-reply on MT processed successfully".format(self.gwid, ref))
 
 
 
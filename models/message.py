@@ -1,9 +1,10 @@
+import os
 import uuid
 import time
 import json
 import bottle
 import rq
-import email
+import email, email.message
 import xml.etree.cElementTree as ET
 
 import traceback
@@ -11,7 +12,8 @@ import traceback
 from constants import *
 from backend.logger import log
 from backend.storage import rdb, rdbq
-from backend.util import makeset, repo, json_error
+from backend.util import makeset, repo, json_error, tx_queue_name
+from backend.mime import MultipartReader, BodyTooLarge, decoded
 import models.template
 import models.gateway
 
@@ -31,25 +33,70 @@ def enqueue_outbound_mms(template_id):
     if m.template.id is None:
         return json_error(404, "Not found", "Message template {} not found".format(template_id))
 
-    m.direction = -1
-    m.origin = mj.get("origin", m.template.origin)
-    m.destination = makeset(mj.get("destination"))
-    m.cc = makeset(mj.get('cc'))
-    m.bcc = makeset(mj.get('bcc'))
-    # make sure we have destination numbers
-    if (len(m.destination) + len(m.cc) + len(m.cc)) == 0:
-        return json_error(400, "Bad request", "No destinations")
-
-    m.linked_id = mj.get('linked_id', "")
-    pri = mj.get('priority', "").lower()
-    m.priority = pri if pri in ACCEPTED_MESSAGE_PRIORITIES else "normal"
-    m.events_url = mj.get('events_url', "")
+    err = m.outbound_from_dict(mj)
+    if err:
+        return json_error(400, "Bad request", err)
 
     m.nq(mj.get('gateway', DEFAULT_GATEWAY))
     m.save()
     return m.as_dict()
 
 
+@bottle.post(URL_ROOT + "mms/outbound/<template_id>/bulk")
+def enqueue_outbound_mms_bulk(template_id):
+    # expected format: dictionary with a 'messages' list, each item in the list having the 
+    # same structure as the body of the single message request above; all the other keys 
+    # in the dictionary are defaults for the items in the list
+    bj = bottle.request.json
+    if not isinstance(bj, dict):
+        return json_error(400, "Bad request", "Expected a JSON object")
+    tpl = models.template.MMSMessageTemplate(template_id)
+    if tpl.id is None:
+        return json_error(404, "Not found", "Message template {} not found".format(template_id))
+    specs = bj.get('messages')
+    if not isinstance(specs, list) or len(specs) == 0:
+        return json_error(400, "Bad request", "No messages")
+
+    defaults = { k: v for k, v in bj.items() if k != 'messages' }
+    ids = []
+    errors = {}
+    jobs = {}
+    callbacks = []
+    pipe = rdb.pipeline(transaction=False)
+    for i, spec in enumerate(specs):
+        if not isinstance(spec, dict):
+            errors[i] = "Expected a JSON object"
+            ids.append(None)
+            continue
+        m = MMSMessage(template=tpl)
+        mj = dict(defaults, **spec)
+        err = m.outbound_from_dict(mj)
+        if err:
+            errors[i] = err
+            ids.append(None)
+            continue
+        m.gateway = mj.get('gateway') or DEFAULT_GATEWAY
+        m.save(pipe)
+        m.set_state([], "SCHEDULED", pipe=pipe, callbacks=callbacks)
+        jobs.setdefault(tx_queue_name(m.gateway, m.priority), []).append(m.tx_job(ttl=MMS_TTL))
+        ids.append(m.id)
+    # message records need to be stored before the gateways pick up the jobs
+    pipe.execute()
+    for q, q_jobs in jobs.items():
+        rq.Queue(q, connection=rdbq).enqueue_many(q_jobs)
+    if callbacks:
+        rq.Queue("QEV", connection=rdbq).enqueue_many(callbacks)
+    log.info("[] {} messages from template {} queued for transmission, {} rejected"
+        .format(len(ids) - len(errors), template_id, len(errors))
+    )
+
+    return {
+        'template_id': template_id,
+        'ids': ids,
+        'errors': errors,
+    }
+
+
 @bottle.post(URL_ROOT + "mms/inbound/<event:re:ack|dr|rr>/<rxid>")
 def enqueue_inbound_mms_event(event, rxid):
     # expected format: dictionary with the following keys
@@ -88,30 +135,44 @@ def enqueue_inbound_mms_event(event, rxid):
 # handle MM7 requests received from carrier side, could be MOs or events for MTs
 @bottle.post(URL_ROOT + "mms/inbound/<gw>")
 def mm7_inbound(gw):
-    log.info("[{}] request received, {} bytes".format(gw, bottle.request.headers['Content-Length']))
-    raw_content = bottle.request.body.read().decode()
+    log.info("[{}] request received, {} bytes".format(gw, bottle.request.headers.get('Content-Length')))
     log.debug("[{}] request headers: {}".format(gw, 
         ["{}: {}".format(h, bottle.request.headers.get(h)) for h in bottle.request.headers.keys()] 
     ))
-    log.debug("[{}] >>>> raw content: {}...".format(gw, raw_content[:4096]))
-    if len(raw_content) > 4096:
-        log.debug("[{}] >>>> ... {}".format(gw, raw_content[-256:]))
-
     bottle.response.content_type = "text/xml"
-    mime_headers = "Mime-Version: 1.0\nContent-Type: " + bottle.request.headers['Content-Type']
-
-    # try parsing lightly, to determine what queue to place this in
-    m = email.message_from_string(mime_headers + "\n\n" + raw_content)
+    length = bottle.request.content_length
+    if MM7_MAX_REQUEST_SIZE and length > MM7_MAX_REQUEST_SIZE:
+        log.warning("[{}] request of {} bytes rejected, larger than {}".format(gw, length, MM7_MAX_REQUEST_SIZE))
+        return bottle.HTTPResponse(status=413, body="Request too large")
+
+    # only the SOAP envelope is parsed here; the request is read as it arrives, and the 
+    # content of an MO goes straight to a file, without being parsed (see below)
+    ct = email.message.Message()
+    ct['Content-Type'] = bottle.request.headers.get('Content-Type', "text/xml")
+    reader = None
     try:
-        if m.is_multipart():
-            parts = m.get_payload()
-            log.debug("[{}] handling as multipart, {} parts".format(gw, len(parts)))
-            env_content = parts[0].get_payload(decode=True).decode()
-            log.debug("[{}] SOAP envelope: {}".format(gw, env_content))
-            env = ET.fromstring(env_content)
+        if ct.get_content_maintype() == "multipart" and ct.get_param("boundary"):
+            reader = MultipartReader(
+                bottle.request.environ['wsgi.input'] if length >= 0 else bottle.request.body, 
+                ct.get_param("boundary"), length if length >= 0 else None, MM7_MAX_REQUEST_SIZE
+            )
+            env_headers = reader.next_part()
+            if env_headers is None:
+                raise ValueError("no parts in multipart request")
+            env_content = decoded(reader.read_all(), env_headers.get('Content-Transfer-Encoding'))
+            log.debug("[{}] handling as multipart, SOAP envelope: {}".format(gw, env_content))
         else:
             log.debug("[{}] handling as single part".format(gw))
-            env = ET.fromstring(m.get_payload(decode=True))
+            env_content = decoded(
+                bottle.request.body.read(), bottle.request.headers.get('Content-Transfer-Encoding')
+            )
+        env = ET.fromstring(env_content)
+    except BodyTooLarge as e:
+        log.warning("[{}] request rejected: {}".format(gw, e))
+        return bottle.HTTPResponse(status=413, body="Request too large")
+    except ValueError as e:
+        log.warning("[{}] Failed to read the request: {}".format(gw, e))
+        return bottle.HTTPResponse(status=400, body="Failed to read the request")
     except ET.ParseError as e:
         log.warning("[{}] Failed to xml-parse the SOAP envelope: {}".format(gw, e))
         return bottle.HTTPResponse(status=400, body="Failed to xml-parse the SOAP envelope")
@@ -140,17 +201,29 @@ def mm7_inbound(gw):
         rx.last_tran_id = transaction_id
         rx.direction = 1
         log.debug("[{}] {} Incoming message {} is an MO".format(gw, rx.id, transaction_id))
+        # save the content part as it arrives, with its headers
+        content_fn = ""
+        content_headers = reader.next_part() if reader else None
+        if content_headers is not None:
+            content_fn = rx.id + ".mm7"
+            fn = repo(TMP_MMS_DIR, content_fn)
+            log.debug("[{}] {} saving media as {}".format(gw, rx.id, fn))
+            try:
+                with open(fn, "wb") as fh:
+                    fh.write(content_headers.as_bytes())
+                    reader.read_body(fh.write)
+            except ValueError as e:
+                os.remove(fn)
+                log.warning("[{}] {} failed to read the MO content: {}".format(gw, rx.id, e))
+                return bottle.HTTPResponse(
+                    status=(413 if isinstance(e, BodyTooLarge) else 400), body="Failed to read the MO content"
+                )
         rx.save()
         rx.template.save()
-        # save raw content
-        fn = repo(TMP_MMS_DIR, rx.id + ".mm7")
-        log.debug("[{}] {} saving media as {}".format(gw, rx.id, transaction_id, fn))
-        with open(fn, "w") as fh:
-            fh.write(parts[1].as_string())
         # schedule message for processing
         q_rx = rq.Queue("QRX-" + gw, connection=rdbq)
         q_rx.enqueue_call(
-            func='models.gateway.inbound', args=( rx.id + ".mm7", ET.tostring(mo_meta), ), 
+            func='models.gateway.inbound', args=( content_fn, ET.tostring(mo_meta), ), 
             job_id=rx.id,
             meta={ 'retries': MAX_GW_RETRIES },
             ttl=30
@@ -174,9 +247,8 @@ def mm7_inbound(gw):
         if txid is None:
             log.info("[{}] Couldnt find reference to original message for MessageID {}".format(gw, provider_msg_id))
             return models.gateway.MM7Gateway.build_response(m_reply_type, transaction_id, provider_msg_id, '2005')
-        tx = MMSMessage(txid)
-        if tx.id is None:
-            log.info("[{}] {} Couldnt find original message record for MessageID {}".format(gw, provider_msg_id))
+        if not MMSMessage.lookup(txid):
+            log.info("[{}] {} Couldnt find original message record for MessageID {}".format(gw, txid, provider_msg_id))
             return models.gateway.MM7Gateway.build_response(m_reply_type, transaction_id, provider_msg_id, '2005')
         # schedule DR for processing
         q_rx = rq.Queue("QRX-" + gw, connection=rdbq)
@@ -223,22 +295,49 @@ class MMSMessage(object):
     rr_requested = False
     created_ts = 0
     processed_ts = 0
+    suffix_match = 10    # digits a reported recipient must share with ours, when not equal
 
 
-    def __init__(self, message_id=None, template_id=None):
+    def __init__(self, message_id=None, template_id=None, template=None):
         if message_id is None:
             self.id = str(uuid.uuid4()).replace("-", "")
             self.last_tran_id = str(uuid.uuid4()).replace("-", "")
             self.created_ts = int(time.time())
-            self.template = models.template.MMSMessageTemplate(template_id)
-            if self.template.id is not None:
-                self.save()
+            if template is not None:
+                # template already loaded, the caller takes care of saving the message
+                self.template = template
+            else:
+                self.template = models.template.MMSMessageTemplate(template_id)
+                if self.template.id is not None:
+                    self.save()
         else:
             self.load(message_id)
 
 
-    def save(self):
-        rdb.hmset('mms-' + self.id, {
+    def outbound_from_dict(self, mj):
+        # set up an outbound message from the parameters of an API request; returns an 
+        # error description if the parameters are not acceptable
+        self.direction = -1
+        self.origin = mj.get("origin", self.template.origin)
+        self.destination = makeset(mj.get("destination"))
+        self.cc = makeset(mj.get('cc'))
+        self.bcc = makeset(mj.get('bcc'))
+        # make sure we have destination numbers
+        if (len(self.destination) + len(self.cc) + len(self.bcc)) == 0:
+            return "No destinations"
+
+        self.linked_id = mj.get('linked_id', "")
+        pri = mj.get('priority', "").lower()
+        self.priority = pri if pri in ACCEPTED_MESSAGE_PRIORITIES else "normal"
+        self.events_url = mj.get('events_url', "")
+        return None
+
+
+    def save(self, pipe=None):
+    # store the message record; all the writes go in a single transaction, unless they 
+    # are added to the pipeline provided by the caller
+        p = pipe or rdb.pipeline()
+        p.hmset('mms-' + self.id, {
             'template_id': self.template.id,
             'peer_ref': self.peer_ref,
             'last_tran_id': self.last_tran_id,
@@ -265,7 +364,9 @@ class MMSMessage(object):
             'created_ts': self.created_ts,
             'processed_ts': self.processed_ts,
         })
-        rdb.expireat('mms-' + self.id, int(time.time()) + MMS_TTL)
+        p.expireat('mms-' + self.id, int(time.time()) + MMS_TTL)
+        if pipe is None:
+            p.execute()
 
 
     def load(self, msgid):
@@ -332,12 +433,7 @@ class MMSMessage(object):
         }
         if self.template:
             d['template'] = self.template.as_dict()
-            all_parts = []
-            for pid in self.template.parts:
-                part = models.template.MMSMessagePart(pid)
-                if part:
-                    all_parts.append(part.as_dict())
-            d['template']['parts'] = all_parts
+            d['template']['parts'] = [ p.as_dict() for p in self.template.get_parts() ]
         d['events'] = []
         events = rdb.lrange('mmsev-' + self.id, 0, -1)
         for ev_json in events:
@@ -351,25 +447,74 @@ class MMSMessage(object):
 
 
     @classmethod
-    def crossref(cls, xref, msgid):
-        rdb.hset("mms-" + msgid, 'peer_ref', xref)
-        rdb.set('mmsxref-' + xref, msgid, ex=int(time.time()) + MMS_TTL)
+    def crossref(cls, xref, ref):
+    # map the peer reference of a transmission to our reference, a message id or a 
+    # submission id (see lookup()), and stamp it on each of the messages it carried
+        p = rdb.pipeline()
+        for msgid in cls.lookup(ref):
+            p.hset("mms-" + msgid, 'peer_ref', xref)
+        p.set('mmsxref-' + xref, ref, ex=MMS_TTL)
+        p.execute()
+
+
+    @classmethod
+    def lookup(cls, ref, recipients=None):
+    # the messages a transmission reference applies to, as { message id: [ recipients ] };
+    # a reference is either a message id, or the id of a submission that carried a part 
+    # of a message, or several messages, to the peer (see models.gateway.Submission). an
+    # empty recipients list applies to all the recipients of the message
+        rmap = rdb.hgetall('mmssub-' + ref)
+        if not rmap:
+            return { ref: list(recipients or []) } if rdb.exists('mms-' + ref) else {}
+        msgs = {}
+        if not recipients:
+            for r, msgid in rmap.items():
+                msgs.setdefault(msgid, []).append(r)
+            return msgs
+        for r in recipients:
+            # the peer may report the numbers with a different prefix than we sent them: 
+            # their last digits are compared then, as long as there are enough of them to
+            # tell the recipients apart
+            msgid = rmap.get(r) if r else None
+            tail = "".join(c for c in (r or "") if c.isdigit())[-cls.suffix_match:]
+            if msgid is None and len(tail) == cls.suffix_match:
+                msgid = next((m for a, m in rmap.items() 
+                    if "".join(c for c in a if c.isdigit())[-cls.suffix_match:] == tail), None
+                )
+            if msgid is None:
+                log.warning("[] submission {} has no recipient {}".format(ref, r))
+            else:
+                msgs.setdefault(msgid, []).append(r)
+        return msgs
+
+
+    def tx_job(self, ttl=30):
+        # transmission job data, as expected by rq's Queue.enqueue_many()
+        return rq.Queue.prepare_data(
+            'models.gateway.send_mms', args=( self.id, ),
+            job_id=self.id,
+            meta={ 'retries': MAX_GW_RETRIES },
+            ttl=ttl
+        )
 
 
     def nq(self, gateway):
         self.gateway = gateway or DEFAULT_GATEWAY
-        q_tx = rq.Queue("QTX-" + self.gateway, connection=rdbq)
+        q_tx = rq.Queue(tx_queue_name(self.gateway, self.priority), connection=rdbq)
         q_tx.enqueue_call(
             func='models.gateway.send_mms', args=( self.id, ), 
             job_id=self.id,
             meta={ 'retries': MAX_GW_RETRIES },
             ttl=30
         )
-        log.info("[] message {} queued for transmission on {}".format(self.id, self.gateway))
+        log.info("[] message {} queued for transmission on {}".format(self.id, q_tx.name))
         self.set_state([], "SCHEDULED")
 
 
-    def set_state(self, dest, state, err="", desc="", gwid="", gw_url="", extra=None):
+    def set_state(self, dest, state, err="", desc="", gwid="", gw_url="", extra=None, pipe=None, callbacks=None):
+    # record a state change event, and send it to the app; when a pipe is provided, the 
+    # event is written in that redis pipeline, and when a callbacks list is provided, 
+    # the callback jobs data is appended to it instead of being queued
 
         log.debug("[{}] {} registering event {}".format(gwid, self.id, state))
         s = {
@@ -385,17 +530,21 @@ class MMSMessage(object):
         s['destinations'] = dest if isinstance(dest, list) else [ dest ]
         if len(s['destinations']) == 0:
             s['destinations'] = [ "*" ]
-        for d in s['destinations']:
-            rdb.rpush("mmsev-" + self.id, json.dumps(s))
-            rdb.expireat("mmsev-" + self.id, int(time.time()) + MMS_TTL)
+        p = pipe or rdb.pipeline()
+        p.rpush("mmsev-" + self.id, *([ json.dumps(s) ] * len(s['destinations'])))
+        p.expireat("mmsev-" + self.id, int(time.time()) + MMS_TTL)
+        if pipe is None:
+            p.execute()
 
         # callback to the app if necessary
         s['message'] = self.id
         url_list = set(self.events_url.split(",") + gw_url.split(","))
         log.debug("[{}] {} sending event to {} with data {}".format(gwid, self.id, url_list, s))
-        q_cb = rq.Queue("QEV", connection=rdbq)
-        for url in url_list:
-            if url:
-                q_cb.enqueue_call("backend.util.cb_post", ( url, json.dumps(s), ))
-
-
+        cb_jobs = [ 
+            rq.Queue.prepare_data("backend.util.cb_post", ( url, json.dumps(s), )) 
+            for url in url_list if url 
+        ]
+        if callbacks is not None:
+            callbacks.extend(cb_jobs)
+        elif cb_jobs:
+            rq.Queue("QEV", connection=rdbq).enqueue_many(cb_jobs)
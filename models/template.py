@@ -2,6 +2,7 @@ import os
 import time
 import uuid
 import json
+import hashlib
 import bottle
 import mimetypes
 
@@ -10,10 +11,104 @@ import traceback
 from constants import *
 from backend.logger import log
 from backend.storage import rdb
-from backend.util import makeset, repo
+from backend.util import makeset, repo, json_error
+from backend.cache import LRUCache
 import models.message
 
 
+# templates and parts are cached in each process, as read from the storage; processes 
+# let each other know about changes on a redis pub/sub channel
+CACHE_CHANNEL = "mmsgw-cache"
+cache = LRUCache(TEMPLATE_CACHE_ITEMS)
+cache_listener = None
+# functions called with the key of the template or part that changed, for dropping 
+# whatever else is derived from it
+invalidation_hooks = []
+
+# load parts, with their content from the blob they refer to
+LOAD_PART_LUA = """
+local function part(pid)
+    local p = redis.call('HGETALL', 'mmspart-' .. pid)
+    for i = 1, #p, 2 do
+        if p[i] == 'content_hash' then
+            table.insert(p, 'content')
+            table.insert(p, redis.call('HGET', 'mmsblob-' .. p[i + 1], 'content') or '')
+        end
+    end
+    return p
+end
+"""
+# load a template and all its parts in a single round trip
+LOAD_TEMPLATE_SCRIPT = LOAD_PART_LUA + """
+local tpl = redis.call('HGETALL', KEYS[1])
+local ret = { tpl }
+for i = 1, #tpl, 2 do
+    if tpl[i] == 'parts' then
+        for pid in string.gmatch(tpl[i + 1], '[^,]+') do
+            table.insert(ret, { pid, part(pid) })
+        end
+    end
+end
+return ret
+"""
+LOAD_PARTS_SCRIPT = LOAD_PART_LUA + """
+local ret = {}
+for i, pid in ipairs(ARGV) do
+    table.insert(ret, part(pid))
+end
+return ret
+"""
+load_template = rdb.register_script(LOAD_TEMPLATE_SCRIPT) if rdb else None
+load_part_list = rdb.register_script(LOAD_PARTS_SCRIPT) if rdb else None
+
+
+def _invalidated(msg):
+    cache.delete(msg['data'])
+    for h in invalidation_hooks:
+        h(msg['data'])
+
+
+def cached(key):
+    global cache_listener
+    if cache_listener is None:
+        ps = rdb.pubsub(ignore_subscribe_messages=True)
+        ps.subscribe(**{ CACHE_CHANNEL: _invalidated })
+        cache_listener = ps.run_in_thread(sleep_time=1, daemon=True)
+    c = cache.get(key)
+    if c is not None and c[0] > time.time() - TEMPLATE_CACHE_TTL:
+        return c[1]
+    return None
+
+
+def cache_put(key, d):
+    cache.put(key, ( time.time(), d ))
+
+
+def invalidate(key, pipe):
+    cache.delete(key)
+    pipe.publish(CACHE_CHANNEL, key)
+
+
+def load_parts(pids):
+    # part objects for a list of part ids, from the cache, or loaded all at once
+    found = {}
+    missing = []
+    for pid in pids:
+        if pid:
+            d = cached('mmspart-' + pid)
+            if d is not None:
+                found[pid] = d
+            else:
+                missing.append(pid)
+    if missing:
+        for pid, pd in zip(missing, load_part_list(args=missing)):
+            if pd:
+                d = dict(zip(pd[::2], pd[1::2]))
+                cache_put('mmspart-' + pid, d)
+                found[pid] = d
+    return [ MMSMessagePart(pid, found[pid]) for pid in pids if pid in found ]
+
+
 @bottle.get(URL_ROOT + "mms/<tplid>")
 def get_mms_template(tplid):
     tpl = MMSMessageTemplate(tplid)
@@ -158,11 +253,10 @@ def update_mms_template(tplid):
 
 @bottle.get(URL_ROOT + "mms_part/<partid>")
 def get_mms_part(partid):
-    p = rdb.hgetall('mmspart-' + partid)
-    if p is None:
+    p = MMSMessagePart(partid)
+    if p.part_id is None:
         return json_error(404, "Not found", "MMS message part '{}' not found".format(partid))
-    p['part_id'] = partid
-    return p
+    return p.as_dict()
 
 
 @bottle.post(URL_ROOT + "mms_part")
@@ -209,7 +303,8 @@ class MMSMessageTemplate(object):
 
     def save(self):
     # save to storage
-        rdb.hmset('mmstpl-' + self.id, {
+        pipe = rdb.pipeline()
+        pipe.hmset('mmstpl-' + self.id, {
             'origin': self.origin,
             'show_sender': self.show_sender,
             'subject': self.subject,
@@ -224,11 +319,24 @@ class MMSMessageTemplate(object):
             'can_redistribute': self.can_redistribute,
             'parts': ",".join(self.parts),
         })
-        rdb.expireat('mmstpl-' + self.id, int(time.time()) + MMS_TEMPLATE_TTL)
+        pipe.expireat('mmstpl-' + self.id, int(time.time()) + MMS_TEMPLATE_TTL)
+        invalidate('mmstpl-' + self.id, pipe)
+        pipe.execute()
+
+    def get_parts(self):
+        return load_parts(self.parts)
 
     def load(self, tplid):
-    # load from storage
-        tpl = rdb.hgetall('mmstpl-' + tplid)
+    # load from cache, or from storage together with all the parts
+        tpl = cached('mmstpl-' + tplid)
+        if tpl is None:
+            ret = load_template(keys=[ 'mmstpl-' + tplid ])
+            tpl = dict(zip(ret[0][::2], ret[0][1::2]))
+            if tpl:
+                cache_put('mmstpl-' + tplid, tpl)
+            for pid, pd in ret[1:]:
+                if pd:
+                    cache_put('mmspart-' + pid, dict(zip(pd[::2], pd[1::2])))
         if tpl:
             self.id = tplid
             self.origin = tpl.get('origin', "")
@@ -287,16 +395,16 @@ class MMSMessageTemplate(object):
             ret['can_redistribute'] = False
         elif self.can_redistribute == 1:
             ret['can_redistribute'] = True
-        for pid in self.parts:
-            if pid:
-                p = MMSMessagePart(pid)
-                ret['parts'].append(p.as_dict())
+        for p in self.get_parts():
+            ret['parts'].append(p.as_dict())
         return ret
 
     def __repr__(self):
         return json.dumps(self.as_dict())
 
-    def add_part_from_mime(self, ep, storage, url_prefix=None):
+    def add_part_from_mime(self, ep, read, storage, url_prefix=None):
+        # ep are the headers of the part, and read(write) hands its decoded content over 
+        # in blocks; media content goes straight to its file in the storage
         p = MMSMessagePart()
         if "Content-Id" in ep:
             p.content_name = ep['Content-Id'].replace("<", "").replace(">", "").replace("\"", "").replace("'", "")
@@ -307,15 +415,19 @@ class MMSMessageTemplate(object):
             return '406', "Content type '{}' not accepted".format(ep['Content-Type'])
         fn = ep.get_filename("") or p.content_name
         if p.content_type == "application/smil" or p.content_type.startswith("text/"):
-            p.content = ep.get_payload(decode=True)
+            content = []
+            read(content.append)
+            p.content = b"".join(content)
         elif p.content_type.startswith("image/") or p.content_type.startswith("audio/"):
+            if os.path.splitext(fn)[-1] not in ACCEPTED_CONTENT_TYPES.values():
+                fn += ACCEPTED_CONTENT_TYPES[p.content_type]
+            path = repo(storage, self.id + "-" + fn)
             try:
-                if os.path.splitext(fn)[-1] not in ACCEPTED_CONTENT_TYPES.values():
-                    fn += ACCEPTED_CONTENT_TYPES[p.content_type]
-                fh = open(repo(storage, self.id + "-" + fn), "wb")
-                fh.write(ep.get_payload(decode=True))
-                fh.close()
+                with open(path, "wb") as fh:
+                    read(fh.write)
             except Exception as e:
+                if os.path.exists(path):
+                    os.remove(path)
                 return '500', "Failed saving file {} in {}: {}".format(fn, storage, e)
             p.content_url = (url_prefix or (API_URL + URL_ROOT)) + self.id + "-" + fn
         else:
@@ -330,35 +442,58 @@ class MMSMessagePart(object):
     part_id = None
     content_url = ""
     content = None
+    content_hash = None      # the content is stored in a blob shared by all the parts with the same content
     content_name = ""
     content_type = ""
 
-    def __init__(self, pid=None):
-        if pid:
+    def __init__(self, pid=None, data=None):
+        if data is not None:
+            self.from_dict(pid, data)
+        elif pid:
             self.load(pid)
         else:
             self.part_id = str(uuid.uuid4()).replace("-", "")
 
     def save(self):
     # save to storage
-        rdb.hmset('mmspart-' + self.part_id, {
+        pipe = rdb.pipeline()
+        pipe.hmset('mmspart-' + self.part_id, {
             'content_url': self.content_url,
             'content_name': self.content_name,
             'content_type': self.content_type,
         })
+        h = None
         if self.content is not None:
-            rdb.hset('mmspart-' + self.part_id, 'content', self.content)
+            # the blob is shared by all the parts with the same content; it is not 
+            # reference counted, it lives as long as the last part saved with it
+            c = self.content.encode() if isinstance(self.content, str) else self.content
+            h = hashlib.sha1(c).hexdigest()
+            pipe.hset('mmspart-' + self.part_id, 'content_hash', h)
+            pipe.hsetnx('mmsblob-' + h, 'content', c)
+            pipe.expireat('mmsblob-' + h, int(time.time()) + MMS_TEMPLATE_TTL)
         else:
-            rdb.hdel('mmspart-' + self.part_id, 'content')
-        rdb.expireat('mmspart-' + self.part_id, int(time.time()) + MMS_TEMPLATE_TTL)
+            pipe.hdel('mmspart-' + self.part_id, 'content_hash')
+        self.content_hash = h
+        pipe.expireat('mmspart-' + self.part_id, int(time.time()) + MMS_TEMPLATE_TTL)
+        invalidate('mmspart-' + self.part_id, pipe)
+        pipe.execute()
 
     def load(self, pid):
-    # load from storage
-        p = rdb.hgetall('mmspart-' + pid)
+    # load from cache or storage
+        p = cached('mmspart-' + pid)
+        if p is None:
+            pd = load_part_list(args=[ pid ])[0]
+            p = dict(zip(pd[::2], pd[1::2]))
+            if p:
+                cache_put('mmspart-' + pid, p)
+        self.from_dict(pid, p)
+
+    def from_dict(self, pid, p):
         if p:
             self.part_id = pid
             self.content_url = p.get('content_url', "")
             self.content = p.get('content')
+            self.content_hash = p.get('content_hash')
             self.content_name = p.get('content_name', "")
             self.content_type = p.get('content_type', "")
 
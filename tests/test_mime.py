@@ -0,0 +1,207 @@
+import io
+import os
+import base64
+import quopri
+import unittest
+
+from backend.mime import MultipartReader, BodyTooLarge, BodyDecoder, WireBody, smtp_send, wire
+
+
+BOUNDARY = "==boundary=="
+
+
+def multipart(parts, eol=b"\r\n", preamble=b"preamble", epilogue=b"epilogue"):
+    # a multipart body from ( headers, content ) tuples
+    b = BOUNDARY.encode()
+    data = preamble + eol
+    for headers, content in parts:
+        data += b"--" + b + eol
+        for name, value in headers:
+            data += name.encode() + b": " + value.encode() + eol
+        data += eol + content + eol
+    return data + b"--" + b + b"--" + eol + epilogue
+
+
+def read_parts(reader):
+    parts = []
+    while True:
+        headers = reader.next_part()
+        if headers is None:
+            return parts
+        parts.append(( headers, reader.read_all() ))
+
+
+class MultipartReaderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.parts = [
+            ( [ ( "Content-Type", "text/xml" ), ( "Content-ID", "<envelope>" ) ], b"<xml>envelope</xml>" ),
+            ( [ ( "Content-Type", "image/png" ) ], os.urandom(5000) ),
+            # a body with lines looking like the delimiter, but not quite
+            ( [ ( "Content-Type", "text/plain" ) ],
+                b"--" + BOUNDARY.encode() + b"x\r\n\r\n--==bound\r\n--" + BOUNDARY[:-1].encode() ),
+            ( [ ( "Content-Type", "text/plain" ) ], b"" ),
+        ]
+
+    def reader(self, data, block_size, **kwargs):
+        r = MultipartReader(io.BytesIO(data), BOUNDARY, **kwargs)
+        r.block_size = block_size
+        return r
+
+    def check(self, data, block_size, **kwargs):
+        parts = read_parts(self.reader(data, block_size, **kwargs))
+        self.assertEqual(len(parts), len(self.parts))
+        for ( headers, content ), ( expected_headers, expected_content ) in zip(parts, self.parts):
+            for name, value in expected_headers:
+                self.assertEqual(headers[name], value)
+            self.assertEqual(content, expected_content)
+
+    def test_block_boundaries(self):
+        # the delimiters and header blocks fall across reads at every offset
+        data = multipart(self.parts)
+        for block_size in list(range(1, 80)) + [ 1000, 4999, 5000, 5001, 64 * 1024 ]:
+            with self.subTest(block_size=block_size):
+                self.check(data, block_size)
+
+    def test_lf_line_endings(self):
+        data = multipart(self.parts, eol=b"\n")
+        for block_size in ( 1, 2, 3, 7, 64, 64 * 1024 ):
+            with self.subTest(block_size=block_size):
+                parts = read_parts(self.reader(data, block_size))
+                self.assertEqual([ c for _, c in parts ], [ c for _, c in self.parts ])
+
+    def test_length(self):
+        # the reader stops at the given length, without reading what follows
+        data = multipart(self.parts)
+        fh = io.BytesIO(data + b"next request")
+        r = MultipartReader(fh, BOUNDARY, length=len(data))
+        r.block_size = 100
+        self.assertEqual(len(read_parts(r)), len(self.parts))
+        self.assertLessEqual(fh.tell(), len(data))
+
+    def test_read_body_in_blocks(self):
+        data = multipart(self.parts)
+        r = self.reader(data, 64)
+        r.next_part()
+        r.read_all()
+        r.next_part()
+        blocks = []
+        r.read_body(blocks.append)
+        self.assertGreater(len(blocks), 1)
+        self.assertTrue(all(len(b) <= 64 for b in blocks))
+        self.assertEqual(b"".join(blocks), self.parts[1][1])
+
+    def test_size_cap(self):
+        data = multipart(self.parts)
+        # the cap counts what was read from the stream, not the size of the parts
+        for block_size in ( 1, 100, 64 * 1024 ):
+            with self.subTest(block_size=block_size):
+                with self.assertRaises(BodyTooLarge):
+                    read_parts(self.reader(data, block_size, max_size=1000))
+                self.check(data, block_size, max_size=len(data))
+
+    def test_truncated(self):
+        data = multipart(self.parts)
+        for cut in ( 10, len(data) // 2, len(data) - len(b"epilogue") - 10 ):
+            with self.subTest(cut=cut):
+                with self.assertRaises(ValueError):
+                    read_parts(self.reader(data[:cut], 64))
+
+    def test_no_parts(self):
+        data = b"--" + BOUNDARY.encode() + b"--\r\n"
+        self.assertEqual(read_parts(self.reader(data, 64)), [])
+
+
+class BodyDecoderTest(unittest.TestCase):
+
+    def decode(self, encoding, data, block_size):
+        out = []
+        d = BodyDecoder(encoding, out.append)
+        for i in range(0, len(data), block_size):
+            d.write(data[i:i + block_size])
+        d.close()
+        return b"".join(out)
+
+    def test_base64(self):
+        content = os.urandom(10000)
+        encoded = base64.encodebytes(content).replace(b"\n", b"\r\n")
+        for block_size in ( 1, 3, 4, 5, 77, 78, 1000 ):
+            with self.subTest(block_size=block_size):
+                self.assertEqual(self.decode("base64", encoded, block_size), content)
+
+    def test_base64_missing_padding(self):
+        self.assertEqual(self.decode("Base64", b"aGVsbG8", 3), b"hello")
+
+    def test_quoted_printable(self):
+        content = ("café = costs 5€; " * 100).encode()
+        encoded = quopri.encodestring(content)
+        for block_size in ( 1, 2, 3, 75, 76, 1000 ):
+            with self.subTest(block_size=block_size):
+                self.assertEqual(self.decode("quoted-printable", encoded, block_size), content)
+
+    def test_identity(self):
+        content = os.urandom(1000)
+        for encoding in ( None, "", "7bit", "8bit", "binary" ):
+            self.assertEqual(self.decode(encoding, content, 7), content)
+
+
+class FakeSMTP(object):
+# records what is sent after the DATA command, and accepts everything
+
+    does_esmtp = True
+
+    def __init__(self):
+        self.data = b""
+        self.replies = []
+
+    def ehlo_or_helo_if_needed(self):
+        pass
+
+    def has_extn(self, name):
+        return False
+
+    def mail(self, sender, options=[]):
+        return 250, b"ok"
+
+    def rcpt(self, recip):
+        return 250, b"ok"
+
+    def putcmd(self, cmd):
+        self.replies.append(( 354, b"go ahead" ) if cmd == "data" else ( 500, b"?" ))
+
+    def getreply(self):
+        return self.replies.pop(0) if self.replies else ( 250, b"queued" )
+
+    def send(self, data):
+        self.data += bytes(data)
+
+    def _rset(self):
+        pass
+
+
+class SmtpSendTest(unittest.TestCase):
+
+    def send(self, *chunks):
+        body = WireBody()
+        for c in chunks:
+            body.write(c)
+        conn = FakeSMTP()
+        self.assertEqual(smtp_send(conn, "a@example.com", "b@example.com", body), {})
+        return conn.data
+
+    def test_no_trailing_line_break(self):
+        # e.g. the MIMEText bodies of acks and delivery reports
+        self.assertEqual(
+            self.send(wire("Subject: ack\n\nDelivery ok")),
+            b"Subject: ack\r\n\r\nDelivery ok\r\n.\r\n"
+        )
+
+    def test_trailing_line_break(self):
+        self.assertEqual(self.send(b"Subject: x\r\n\r\nbody\r\n"), b"Subject: x\r\n\r\nbody\r\n.\r\n")
+
+    def test_line_break_across_chunks(self):
+        self.assertEqual(self.send(b"body\r", b"\n"), b"body\r\n.\r\n")
+        self.assertEqual(self.send(b"body\r\n", b"x"), b"body\r\nx\r\n.\r\n")
+
+    def test_dot_stuffing(self):
+        self.assertEqual(self.send(b".a\r\n", b".b\r\n.c"), b"..a\r\n..b\r\n..c\r\n.\r\n")
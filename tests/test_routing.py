@@ -0,0 +1,99 @@
+import unittest
+import configparser
+
+from backend.routing import RoutingTable, RoutingIndex
+
+
+class RoutingTableTest(unittest.TestCase):
+
+    def setUp(self):
+        self.table = RoutingTable({
+            'gw@example.com': "ADDRESS",
+            'example.com': "DOMAIN",
+            '*.example.com': "WILDCARD",
+            '*.deep.example.com': "DEEP",
+            '@other.com': "AT_DOMAIN",
+            '*@third.com': "STAR_DOMAIN",
+        })
+
+    def test_address_first(self):
+        self.assertEqual(self.table.match("gw@example.com"), "ADDRESS")
+
+    def test_domain_next(self):
+        self.assertEqual(self.table.match("someone@example.com"), "DOMAIN")
+        self.assertEqual(self.table.match("someone@other.com"), "AT_DOMAIN")
+        self.assertEqual(self.table.match("someone@third.com"), "STAR_DOMAIN")
+
+    def test_wildcard_last(self):
+        self.assertEqual(self.table.match("someone@mms.example.com"), "WILDCARD")
+        self.assertEqual(self.table.match("someone@a.b.example.com"), "WILDCARD")
+
+    def test_longest_wildcard(self):
+        self.assertEqual(self.table.match("someone@x.deep.example.com"), "DEEP")
+        self.assertEqual(self.table.match("someone@deep.example.com"), "WILDCARD")
+
+    def test_wildcard_not_the_domain_itself(self):
+        table = RoutingTable({ '*.example.com': "WILDCARD" })
+        self.assertIsNone(table.match("someone@example.com"))
+
+    def test_host_names(self):
+        self.assertEqual(self.table.match("example.com"), "DOMAIN")
+        self.assertEqual(self.table.match("mx1.example.com"), "WILDCARD")
+
+    def test_case_insensitive(self):
+        self.assertEqual(self.table.match("GW@Example.COM"), "ADDRESS")
+        self.assertEqual(RoutingTable({ 'GW@EXAMPLE.COM': "X" }).match("gw@example.com"), "X")
+
+    def test_no_match(self):
+        self.assertIsNone(self.table.match("someone@elsewhere.org"))
+        self.assertIsNone(self.table.match("com"))
+        self.assertIsNone(self.table.match(""))
+        self.assertIsNone(self.table.match(None))
+
+
+class RoutingIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        cfg = configparser.ConfigParser()
+        cfg.read_string(
+            "[receivers]\n"
+            "gw@mydomain.com = RECEIVER\n"
+            "*.mydomain.com = RECEIVER_WILDCARD\n"
+            "[peers]\n"
+            "10.0.0.1 = PEER_IP\n"
+            "*.carrier.com = PEER_NAME\n"
+            "[senders]\n"
+            "carrier2.com = SENDER\n"
+        )
+        self.index = RoutingIndex(cfg)
+
+    def test_receiver_before_peer_and_sender(self):
+        self.assertEqual(
+            self.index.lookup("x@carrier2.com", "Gateway <gw@mydomain.com>", [ "10.0.0.1" ]),
+            "RECEIVER"
+        )
+        self.assertEqual(
+            self.index.lookup("x@carrier2.com", "gw@mms.mydomain.com", [ "10.0.0.1" ]),
+            "RECEIVER_WILDCARD"
+        )
+
+    def test_peer_before_sender(self):
+        self.assertEqual(self.index.lookup("x@carrier2.com", "a@b.com", [ "10.0.0.1" ]), "PEER_IP")
+        self.assertEqual(
+            self.index.lookup("x@carrier2.com", "a@b.com", [ "192.168.1.1", "mx.carrier.com" ]),
+            "PEER_NAME"
+        )
+
+    def test_sender_last(self):
+        self.assertEqual(self.index.lookup("x@carrier2.com", "a@b.com", [ "192.168.1.1" ]), "SENDER")
+        self.assertEqual(self.index.lookup("X <x@carrier2.com>", "a@b.com"), "SENDER")
+
+    def test_unroutable(self):
+        self.assertIsNone(self.index.lookup("x@nowhere.com", "a@b.com", [ "192.168.1.1" ]))
+
+    def test_missing_sections(self):
+        cfg = configparser.ConfigParser()
+        cfg.read_string("[receivers]\ngw@mydomain.com = GW01\n")
+        index = RoutingIndex(cfg)
+        self.assertEqual(index.lookup("x@y.com", "gw@mydomain.com"), "GW01")
+        self.assertIsNone(index.lookup("x@y.com", "a@b.com", [ "10.0.0.1" ]))
@@ -0,0 +1,76 @@
+import time
+import unittest
+from unittest import mock
+
+try:
+    import fakeredis
+    import lupa
+except ImportError:
+    fakeredis = None
+
+import backend.throttle
+from backend.throttle import TokenBucket
+
+
+@unittest.skipIf(fakeredis is None, "fakeredis with lua support is not installed")
+class TokenBucketTest(unittest.TestCase):
+
+    def setUp(self):
+        # the script reads the clock from the redis TIME command, which fakeredis
+        # answers with the local time
+        self.rdbq = fakeredis.FakeRedis()
+        patcher = mock.patch.object(backend.throttle, 'rdbq', self.rdbq)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_burst(self):
+        bucket = TokenBucket("burst", 10, 5)
+        self.assertEqual([ bucket.acquire() for _ in range(5) ], [ 0 ] * 5)
+        self.assertAlmostEqual(bucket.acquire(), 0.1, delta=0.02)
+        self.assertAlmostEqual(bucket.acquire(), 0.2, delta=0.02)
+
+    def test_burst_defaults_to_rate(self):
+        bucket = TokenBucket("rate", 3)
+        self.assertEqual([ bucket.acquire() for _ in range(3) ], [ 0 ] * 3)
+        self.assertGreater(bucket.acquire(), 0)
+
+    def test_refill(self):
+        bucket = TokenBucket("refill", 20, 2)
+        bucket.acquire(2)
+        self.assertAlmostEqual(bucket.level(), 0, delta=0.5)
+        time.sleep(0.1)
+        self.assertAlmostEqual(bucket.level(), 2, delta=0.5)
+        self.assertEqual(bucket.acquire(), 0)
+
+    def test_refill_capped_at_burst(self):
+        bucket = TokenBucket("cap", 100, 3)
+        bucket.acquire()
+        time.sleep(0.1)
+        self.assertEqual(bucket.level(), 3)
+        self.assertEqual([ bucket.acquire() for _ in range(3) ], [ 0 ] * 3)
+        self.assertGreater(bucket.acquire(), 0)
+
+    def test_overdraw(self):
+        # every caller takes its token, and waits for its own turn
+        bucket = TokenBucket("overdraw", 10, 1)
+        waits = [ bucket.acquire() for _ in range(4) ]
+        self.assertEqual(waits[0], 0)
+        for n, w in enumerate(waits[1:], 1):
+            self.assertAlmostEqual(w, n / 10., delta=0.02)
+        self.assertAlmostEqual(bucket.level(), -3, delta=0.2)
+
+    def test_level_from_another_instance(self):
+        # the API reads the bucket without knowing rate and burst
+        TokenBucket("shared", 10, 5).acquire(5)
+        self.assertAlmostEqual(TokenBucket("shared", 0).level(), 0, delta=0.2)
+        self.assertIsNone(TokenBucket("unused", 0).level())
+
+    def test_bucket_expires(self):
+        bucket = TokenBucket("expire", 10, 5)
+        bucket.acquire()
+        self.assertGreater(self.rdbq.ttl(bucket.key), 0)
+
+    def test_unthrottled(self):
+        bucket = TokenBucket("off", 0)
+        self.assertEqual([ bucket.acquire() for _ in range(10) ], [ 0 ] * 10)
+        self.assertFalse(self.rdbq.exists(bucket.key))